@@ -1,8 +1,13 @@
+from collections import OrderedDict
 import json
-import httpx
+import os
+import re
+import time
+import unicodedata
 from botx.models import PrivateMessage
 
 import config
+import utils
 
 
 ARTICLE_COMMANDS = {
@@ -25,6 +30,96 @@ PREFIX_COMMANDS = {
 }
 
 
+class IntentCache:
+    """
+    LLM 意图识别结果的缓存, 按规范化后的文本查找.
+    超过 maxsize 时淘汰最久没用过的, 超过 ttl 秒的结果视为过期
+    """
+
+    def __init__(self, maxsize: int, ttl: float, path: str = ""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        # 文本 -> (写入时间, 结果)
+        self._data: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> dict | None:
+        item = self._data.get(key)
+        if item is None or time.time() - item[0] > self.ttl:
+            self._data.pop(key, None)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: str, value: dict):
+        self._data[key] = (time.time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                items = json.load(f)
+        except (OSError, ValueError) as e:
+            from core import bot
+
+            bot.getLogger().warning(f"读取意图缓存失败: {e}")
+            return
+        now = time.time()
+        for key, saved, value in items:
+            if now - saved <= self.ttl:
+                self._data[key] = (saved, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def snapshot(self) -> list:
+        """复制当前内容, 要在事件循环线程中调用, 之后可以交给其他线程写入"""
+        return [[k, saved, v] for k, (saved, v) in self._data.items()]
+
+    def write(self, items: list):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, mode="w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = f"{self.hits / total:.0%}" if total else "-"
+        return f"命中 {self.hits}, 未命中 {self.misses} ({rate}), 共 {len(self._data)} 条"
+
+
+cache = IntentCache(
+    maxsize=config.AGENT_CACHE_SIZE,
+    ttl=config.AGENT_CACHE_TTL,
+    path=config.AGENT_CACHE_PATH,
+)
+
+# 句尾不影响意思的标点和语气词
+_PADDING = re.compile(r"[\W_啊呀呢吧嘛哦喔]+$")
+
+
+def normalize_text(raw: str) -> str:
+    """用作缓存的 key: 统一全角半角和大小写, 去掉空白和句尾的标点"""
+    s = unicodedata.normalize("NFKC", raw)
+    if s.lstrip().startswith("#"):
+        # 像命令的文本, 空格和标点关系到命令写得对不对, 只合并连续的空白
+        return " ".join(s.split())
+    s = "".join(s.lower().split())
+    return _PADDING.sub("", s) or s
+
+
 def normalize_command(raw: str) -> str:
     return " ".join(raw.strip().replace("＃", "#").split())
 
@@ -47,6 +142,11 @@ async def ai_suggest_intent(raw: str) -> dict:
     if not config.AGENT_ROUTER_BASE or not config.AGENT_ROUTER_KEY:
         return {"intent_candidates": []}
 
+    key = normalize_text(raw)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
     prompt = (
         "你是“苏州实验中学校墙”的智能助手, 任务是把用户短文本映射为墙的命令或友好回复。"
         '最终请返回 JSON: {"intent_candidates":[{"label":"","suggestion":"","confidence":"","reason":""}]}\n\n'
@@ -93,49 +193,39 @@ async def ai_suggest_intent(raw: str) -> dict:
     resp_obj = {"intent_candidates": []}
     try:
         url = config.AGENT_ROUTER_BASE.rstrip("/") + "/v1/chat/completions"
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r = await client.post(url, headers=headers, json=body)
-            r.raise_for_status()
-            j = r.json()
-            text = ""
-            if "choices" in j and len(j["choices"]) > 0:
-                cand = j["choices"][0]
-                if (
-                    isinstance(cand, dict)
-                    and "message" in cand
-                    and isinstance(cand["message"], dict)
-                ):
-                    text = cand["message"].get("content", "") or ""
-                else:
-                    text = cand.get("text", "") or ""
-            if not text and "text" in j:
-                text = j.get("text", "")
-
-            # 尝试解析 JSON
-            try:
-                parsed = json.loads(text)
-                resp_obj = parsed
-            except Exception:
-                # 尝试提取文本中的 JSON 块
-                start = text.find("{")
-                end = text.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    snippet = text[start : end + 1]
-                    try:
-                        parsed = json.loads(snippet)
-                        resp_obj = parsed
-                    except Exception:
-                        resp_obj = {
-                            "intent_candidates": [
-                                {
-                                    "label": "无法结构化解析",
-                                    "suggestion": "",
-                                    "confidence": "低",
-                                    "reason": text[:400],
-                                }
-                            ]
-                        }
-                else:
+        r = await utils.http().post(url, headers=headers, json=body, timeout=15.0)
+        r.raise_for_status()
+        j = r.json()
+        text = ""
+        if "choices" in j and len(j["choices"]) > 0:
+            cand = j["choices"][0]
+            if (
+                isinstance(cand, dict)
+                and "message" in cand
+                and isinstance(cand["message"], dict)
+            ):
+                text = cand["message"].get("content", "") or ""
+            else:
+                text = cand.get("text", "") or ""
+        if not text and "text" in j:
+            text = j.get("text", "")
+
+        # 尝试解析 JSON
+        try:
+            parsed = json.loads(text)
+            resp_obj = parsed
+            cache.put(key, resp_obj)
+        except Exception:
+            # 尝试提取文本中的 JSON 块
+            start = text.find("{")
+            end = text.rfind("}")
+            if start != -1 and end != -1 and end > start:
+                snippet = text[start : end + 1]
+                try:
+                    parsed = json.loads(snippet)
+                    resp_obj = parsed
+                    cache.put(key, resp_obj)
+                except Exception:
                     resp_obj = {
                         "intent_candidates": [
                             {
@@ -146,6 +236,17 @@ async def ai_suggest_intent(raw: str) -> dict:
                             }
                         ]
                     }
+            else:
+                resp_obj = {
+                    "intent_candidates": [
+                        {
+                            "label": "无法结构化解析",
+                            "suggestion": "",
+                            "confidence": "低",
+                            "reason": text[:400],
+                        }
+                    ]
+                }
     except Exception as e:
         from core import bot
 
@@ -0,0 +1,146 @@
+"""
+投稿归档. 推送或驳回超过 ARCHIVE_AFTER_DAYS 天的投稿从 data.db 移到 archive.db,
+文件保留审核群里看到的预览图和投稿者发送的原图, 放在 data/archive/{id}/ 下,
+原图打包成一个 originals.zip, 其他尺寸都删掉. 主表里只剩还在处理中的投稿.
+"""
+
+import asyncio
+import os
+import shutil
+import time
+import zipfile
+
+import config
+import image
+from models import Approval, Article, ArchivedArticle, Status, db, archive_db
+import repo
+import store
+
+ROOT = "./data/archive"
+# 每批移动的投稿数量, 避免一次事务太大
+BATCH = 200
+ORIGINALS = "originals.zip"
+
+
+def folder(id: int | str) -> str:
+    return os.path.join(ROOT, str(id))
+
+
+def images(id: int | str) -> list[str]:
+    """归档投稿的预览图, 按从上到下的顺序"""
+    path = folder(id)
+    if not os.path.isdir(path):
+        return []
+    files = sorted(
+        (f for f in os.listdir(path) if f.split(".")[0].isdigit()),
+        key=lambda f: int(f.split(".")[0]),
+    )
+    return [os.path.abspath(os.path.join(path, f)) for f in files]
+
+
+def preview(id: int | str) -> list[str]:
+    """审核群里显示的预览图, 归档和未归档的投稿都能用"""
+    archived = images(id)
+    if archived:
+        return archived
+    if not os.path.isfile(f"./data/{id}/image.png"):
+        return []
+    return image.output_paths(id, "group")
+
+
+def originals(id: int | str) -> str | None:
+    """归档投稿的原图压缩包, 没有原图时为 None"""
+    path = os.path.join(folder(id), ORIGINALS)
+    return os.path.abspath(path) if os.path.isfile(path) else None
+
+
+def remove(id: int | str):
+    shutil.rmtree(folder(id), ignore_errors=True)
+
+
+def _copy_preview(id: int):
+    src = f"./data/{id}"
+    if os.path.isfile(os.path.join(src, "image.png")):
+        dst = folder(id)
+        os.makedirs(dst, exist_ok=True)
+        for i, path in enumerate(image.output_paths(id, "group")):
+            shutil.copyfile(path, os.path.join(dst, f"{i}{os.path.splitext(path)[1]}"))
+
+
+def _zip_originals(id: int):
+    """原图按发送顺序打包, 图片本身已经压缩过, 只存储不再压缩"""
+    files = image.raw_images(id)
+    if not files:
+        return
+    dst = folder(id)
+    os.makedirs(dst, exist_ok=True)
+    tmp = os.path.join(dst, ORIGINALS + ".tmp")
+    with zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_STORED) as z:
+        order = f"./data/{id}/images.json"
+        if os.path.isfile(order):
+            z.write(order, "images.json")
+        for path in files:
+            z.write(path, os.path.basename(path))
+    os.replace(tmp, os.path.join(dst, ORIGINALS))
+
+
+async def _pack(id: int):
+    """保留预览图和原图的压缩包, 文件夹连同仓库中的引用一起删掉"""
+    if not os.path.isdir(f"./data/{id}"):
+        return
+    await asyncio.to_thread(_copy_preview, id)
+    await asyncio.to_thread(_zip_originals, id)
+    await store.remove(f"./data/{id}")
+
+
+def _candidates(before: float) -> list[int]:
+    return [
+        a.id
+        for a in Article.select(Article.id)
+        .where(
+            Article.status.in_([Status.PUBLISHED, Status.REJECTED])
+            & (Article.time < before)
+        )
+        .order_by(Article.id.asc())
+        .limit(BATCH)
+    ]
+
+
+def _move(ids: list[int]):
+    rows = list(Article.select().where(Article.id.in_(ids)).dicts())
+    # 先写归档库再删主库, 中途出错时重新执行也不会丢数据.
+    # 归档库里已经有同一个 id 时, 只有内容完全相同(上次中途出错)才跳过, 否则报错
+    existing = {
+        a["id"]: a
+        for a in ArchivedArticle.select()
+        .where(ArchivedArticle.id.in_(ids))
+        .dicts()
+    }
+    for row in rows:
+        if row["id"] in existing and existing[row["id"]] != row:
+            raise ValueError(f"归档库中已有不同的投稿 #{row['id']}")
+    rows = [row for row in rows if row["id"] not in existing]
+    with archive_db.atomic():
+        if rows:
+            ArchivedArticle.insert_many(rows).execute()
+    with db.atomic():
+        Article.delete().where(Article.id.in_(ids)).execute()
+        Approval.delete().where(Approval.article.in_(ids)).execute()
+
+
+async def run() -> int:
+    """执行一次归档, 返回归档的投稿数量"""
+    before = time.time() - config.ARCHIVE_AFTER_DAYS * 86400
+    total = 0
+    while ids := await repo.run(_candidates, before):
+        start = time.perf_counter()
+        await repo.run(_move, ids)
+        for id in ids:
+            await _pack(id)
+        total += len(ids)
+        from core import bot
+
+        bot.getLogger().info(
+            f"已归档 {len(ids)} 个投稿, 用时 {time.perf_counter() - start:.2f}s"
+        )
+    return total
@@ -29,3 +29,94 @@ AGENT_MODEL = os.getenv("AGENT_MODEL", "gpt-4o-mini")
 
 GUILD_ID = os.getenv("GUILD_ID")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
+
+# 常驻浏览器的页面数量, 以及每个页面渲染多少次后回收
+RENDER_PAGES = int(os.getenv("RENDER_PAGES", 2))
+RENDER_RECYCLE = int(os.getenv("RENDER_RECYCLE", 50))
+
+# 同时渲染的任务数, 以及排队上限
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", RENDER_PAGES))
+RENDER_QUEUE = int(os.getenv("RENDER_QUEUE", 20))
+
+# 渲染倍率, 存档的 image.png 是该倍率下的无损 PNG
+RENDER_SCALE = float(os.getenv("RENDER_SCALE", 3))
+# 各用途的输出图片, 格式为 "格式:质量:缩放", 缩放相对于存档图. 格式可选 png/webp/jpeg
+# 私聊预览
+IMAGE_PREVIEW = os.getenv("IMAGE_PREVIEW", "webp:80:0.67")
+# 审核群
+IMAGE_GROUP = os.getenv("IMAGE_GROUP", "webp:85:1")
+# 上传到 QQ 空间和频道
+IMAGE_UPLOAD = os.getenv("IMAGE_UPLOAD", "jpeg:90:1")
+
+# 头像和其他远程资源的本地缓存时间 (秒)
+AVATAR_TTL = int(os.getenv("AVATAR_TTL", 24 * 60 * 60))
+ASSET_TTL = int(os.getenv("ASSET_TTL", 7 * 24 * 60 * 60))
+# 下载头像和其他远程资源最多等待的秒数, 渲染会等这些下载
+AVATAR_TIMEOUT = float(os.getenv("AVATAR_TIMEOUT", 5))
+ASSET_TIMEOUT = float(os.getenv("ASSET_TIMEOUT", 5))
+
+# 处理投稿图片的进程数
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+# 用户停止发送消息若干秒后在后台预先渲染预览图
+SPECULATIVE_RENDER = os.getenv("SPECULATIVE_RENDER", "false").lower() == "true"
+SPECULATIVE_DELAY = float(os.getenv("SPECULATIVE_DELAY", 5))
+
+# 纯文字投稿用 Pillow 直接绘制, 不启动 Chromium. 需要中文字体, 留空则自动查找
+FAST_RENDER = os.getenv("FAST_RENDER", "true").lower() == "true"
+FONT_PATH = os.getenv("FONT_PATH", "")
+FONT_BOLD_PATH = os.getenv("FONT_BOLD_PATH", "")
+
+# 长投稿按消息切成多张图片, 每张不超过这个高度 (CSS 像素), 0 为不切分
+RENDER_TILE_HEIGHT = int(os.getenv("RENDER_TILE_HEIGHT", 0))
+
+# 全局 HTTP 连接池
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+
+# 投稿图片下载的并发数, 失败重试次数和首次重试等待的秒数 (之后翻倍)
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 4))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", 1))
+
+# 单张图片和一次投稿所有图片的大小上限 (字节)
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", 20 * 1024 * 1024))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 100 * 1024 * 1024))
+
+# SQLite 页缓存和内存映射的大小 (KiB / 字节)
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", 16 * 1024))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+
+# 多久用数据库校正一次内存中的投稿统计 (秒)
+STATS_RECONCILE = int(os.getenv("STATS_RECONCILE", 600))
+
+# 超过这个时间 (毫秒) 的数据库查询记到日志里
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 50))
+
+# 推送或驳回超过多少天的投稿移到归档库, 以及多久检查一次 (小时)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 24))
+
+# 会话日志攒多久写一次 (秒), 以及超过多少行时压缩
+JOURNAL_FLUSH = float(os.getenv("JOURNAL_FLUSH", 0.5))
+JOURNAL_COMPACT = int(os.getenv("JOURNAL_COMPACT", 5000))
+
+# 等待锁超过多少秒时记到日志里
+LOCK_WARN = float(os.getenv("LOCK_WARN", 1))
+
+# 一次投稿最多的消息段数, 文字字节数和图片数
+SESSION_MAX_SEGMENTS = int(os.getenv("SESSION_MAX_SEGMENTS", 200))
+SESSION_MAX_TEXT = int(os.getenv("SESSION_MAX_TEXT", 20000))
+SESSION_MAX_IMAGES = int(os.getenv("SESSION_MAX_IMAGES", 30))
+
+# 投稿多久没有确认就自动取消 (秒), 以及提前多久提醒, 为 0 时不提醒
+SESSION_TIMEOUT = int(os.getenv("SESSION_TIMEOUT", 3600))
+SESSION_WARN = int(os.getenv("SESSION_WARN", 300))
+
+# AI 意图识别结果的缓存: 条数上限, 有效期 (秒), 保存位置 (留空不保存)
+AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", 1000))
+AGENT_CACHE_TTL = int(os.getenv("AGENT_CACHE_TTL", 7 * 86400))
+AGENT_CACHE_PATH = os.getenv("AGENT_CACHE_PATH", "./data/agent_cache.json")
@@ -1,14 +1,20 @@
 import asyncio
 import os
-import shutil
 import time
 import random
 import traceback
 
 import agent
+import archive
 import config
-from models import Article, Session, Status
+from models import Session, Status
 import image
+import journal
+import locks
+import render
+import repo
+import stats
+import store
 import utils
 
 from fastapi import FastAPI, HTTPException
@@ -45,6 +51,14 @@ def get_file_url(path: str):
     return f"http://{config.HOST}:{config.PORT}/image?p={path}&t={token}"
 
 
+def image_codes(id: int | str, profile: str) -> str:
+    return file_codes(image.output_paths(id, profile))
+
+
+def file_codes(paths: list[str]) -> str:
+    return "".join(f"[CQ:image,file={get_file_url(path)}]" for path in paths)
+
+
 @app.get("/image")
 def get_image(p: str, t: str):
     if t != token:
@@ -56,9 +70,6 @@ sessions: dict[User, Session] = {}
 
 start_time = time.time()
 
-# 管理的一些操作要上锁
-lock = asyncio.Lock()
-
 scheduler = AsyncIOScheduler()
 
 
@@ -133,18 +144,29 @@ async def article(msg: PrivateMessage):
         return
 
     parts = command.split(" ")
-    id = Article.create(
+    now = time.time()
+    id = await repo.create_article(
         sender_id=msg.sender.user_id,
         sender_name=msg.sender.nickname,
         anonymous=anonymous,
-        time=time.time(),
+        time=now,
         single="单发" in parts,
-    ).id
-
-    sessions[msg.sender] = Session(id=id, anonymous=anonymous)
-    if os.path.exists(f"./data/{id}"):
-        shutil.rmtree(f"./data/{id}")
+    )
+    stats.created(id)
+
+    sessions[msg.sender] = Session(id=id, anonymous=anonymous, created=now)
+    schedule_expiry(msg.sender, sessions[msg.sender])
+    journal.record(
+        "open",
+        msg.sender.user_id,
+        name=msg.sender.nickname,
+        id=id,
+        anonymous=anonymous,
+        time=now,
+    )
+    await store.remove(f"./data/{id}")
     os.makedirs(f"./data/{id}", exist_ok=True)
+    image.prefetch_avatar(10000 if anonymous else msg.sender.user_id)
 
     def status_words(value: bool) -> str:
         return "是" if value else "否"
@@ -184,35 +206,206 @@ async def end(msg: PrivateMessage):
             "你好像啥都没有说呢😵‍💫\n不想投稿了请输入:  \n\n#取消\n\n或者说点什么再输入:  \n\n#结束"
         )
         return
-    await msg.reply("正在生成预览图🚀\n请稍等片刻")
     ses = sessions[msg.sender]
 
     bot.getLogger().debug(ses.contents)
 
-    for content in ses.contents:
-        for m in content:
-            if m["type"] == "image":
-                filepath = f"./data/{ses.id}/{m['data']['file']}"
-                if not os.path.isfile(filepath):
-                    await utils.download(
-                        m["data"]["url"].replace("https://", "http://"), filepath
-                    )
+    admin = await is_admin(msg.sender.user_id)
+    key = image.render_key(msg.sender, ses.anonymous, ses.contents, admin)
+    version = ses.version
+    path = os.path.abspath(f"./data/{ses.id}/image.png")
+    if key != ses.image_key or not os.path.isfile(path):
+        job = ses.speculative_job
+        if job is not None and job.tag == key and not job.future.cancelled():
+            # 后台预渲染的正好是当前内容, 提到正常队列里等它完成
+            render.queue.promote(job)
+        else:
+            cancel_speculative(ses)
+            try:
+                await prepare_images(ses)
+            except utils.DownloadError as e:
+                await msg.reply(
+                    f"有图片没法使用😵‍💫: {e}\n请撤回这张图片后再发送:  \n\n#结束"
+                )
+                return
+            try:
+                job = await render.queue.submit(
+                    msg.sender.user_id, render_job(msg.sender, ses, admin), tag=key
+                )
+            except asyncio.QueueFull:
+                await msg.reply(
+                    "现在生成预览图的人太多啦😵‍💫\n请过一会再发送:  \n\n#结束"
+                )
+                return
+
+        ahead = render.queue.position(job)
+        await msg.reply(
+            "正在生成预览图🚀\n"
+            + (f"前面还有 {ahead} 人在排队, " if ahead else "")
+            + "请稍等片刻"
+        )
+        path = await job.wait()
+        if path is None:
+            # 被 #取消 或者新的 #结束 顶掉了
+            return
+        if ses.version != version or sessions.get(msg.sender) is not ses:
+            # 渲染期间又发了或撤回了消息, 这张预览图已经不是当前内容
+            if sessions.get(msg.sender) is ses:
+                await msg.reply(
+                    "生成预览图的时候投稿内容有变化😵‍💫\n请重新发送:  \n\n#结束"
+                )
+            return
+        ses.image_key = key
+
+    ses.previewed = True
+    await msg.reply(
+        f"{image_codes(ses.id, 'preview')}这样投稿可以吗😘\n可以的话请发送:  \n\n#确认\n\n不可以就发送:  \n\n#取消"
+    )
+
+
+async def restore():
+    """重启后从日志恢复未结束的投稿, 并清理没有会话的投稿和文件夹"""
+    created = await repo.article_ids(Status.CREATED)
+    for user_id, s in journal.load().items():
+        if s["id"] not in created:
+            # 投稿已经不在了, 比如日志写入前就被删除
+            journal.record("close", user_id)
+            continue
+        user = User(nickname=s["name"], user_id=user_id)  # type: ignore
+        ses = Session(id=s["id"], anonymous=s["anonymous"])
+        if s["time"] is not None:
+            ses.created = s["time"]
+        for items in s["contents"]:
+            ses.add(items[0]["id"], items)
+        sessions[user] = ses
+        # 停机期间已经超时的投稿等 bot 连上之后再取消, 否则没法通知用户
+        schedule_expiry(user, ses, minimum=60)
+        # QQ 的图片链接可能已经过期, 已经下载好的图片会直接跳过
+        for m in (m for c in ses.contents for m in c if m["type"] == "image"):
+            start_download(ses, m)
+
+    open_ids = {ses.id for ses in sessions.values()}
+    for id in created - open_ids:
+        if await repo.delete_article(id):
+            stats.removed(id)
+        await store.remove(f"./data/{id}")
+    known = await repo.article_ids()
+    for name in os.listdir("./data"):
+        if name.isdigit() and int(name) not in known:
+            await store.remove(f"./data/{name}")
+    bot.getLogger().info(
+        f"恢复了 {len(sessions)} 个投稿, 清理了 {len(created - open_ids)} 个中断的投稿"
+    )
+
 
+async def is_admin(user_id: int) -> bool:
     vips = (await bot.call_api("get_group_member_list", {"group_id": config.GROUP}))[
         "data"
     ]
+    return any(map(lambda v: v["user_id"] == user_id, vips))
 
-    path = await image.generate_img(
+
+async def prepare_images(ses: Session):
+    """等待所有图片下载和处理完成, 收到消息时已经开始的下载直接复用"""
+    images = [m for c in ses.contents for m in c if m["type"] == "image"]
+    tasks = [start_download(ses, m) for m in images]
+    if not tasks:
+        return
+    await asyncio.wait(tasks)
+    for task in tasks:
+        if not task.cancelled():
+            task.result()
+
+
+def start_download(ses: Session, m: dict) -> asyncio.Task:
+    file = m["data"]["file"]
+    task = ses.downloads.get(file)
+    if task is None or (
+        task.done() and (task.cancelled() or task.exception() is not None)
+    ):
+        task = asyncio.create_task(ingest(ses, m))
+        task.add_done_callback(_log_download)
+        ses.downloads[file] = task
+    return task
+
+
+def cancel_downloads(ses: Session, files: list[str] | None = None):
+    """取消下载, 已经下载完的文件退回占用的额度"""
+    for file in list(ses.downloads) if files is None else files:
+        task = ses.downloads.pop(file, None)
+        if task is not None:
+            task.cancel()
+        ses.budget.release(file)
+
+
+async def ingest(ses: Session, m: dict):
+    filepath = f"./data/{ses.id}/{m['data']['file']}"
+    if not os.path.isfile(filepath):
+        await store.fetch(
+            m["data"]["url"].replace("https://", "http://"),
+            m["data"]["file"],
+            filepath,
+            budget=ses.budget,
+        )
+    await image.prepare(ses.id, m)
+
+
+def _log_download(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        bot.getLogger().warning(f"下载图片失败: {task.exception()}")
+
+
+def render_job(user: User, ses: Session, admin: bool):
+    return lambda: image.generate_img(
         ses.id,
-        user=msg.sender,
+        user=user,
         contents=ses.contents,
-        admin=any(map(lambda v: v["user_id"] == msg.sender.user_id, vips)),
+        admin=admin,
         anonymous=ses.anonymous,
     )
 
-    await msg.reply(
-        f"[CQ:image,file={get_file_url(path)}]这样投稿可以吗😘\n可以的话请发送:  \n\n#确认\n\n不可以就发送:  \n\n#取消"
-    )
+
+def schedule_speculative(user: User, ses: Session):
+    """用户停下来一段时间后在后台先渲染好, 之后 #结束 可以直接出图"""
+    cancel_speculative(ses)
+    if config.SPECULATIVE_RENDER:
+        ses.speculative = asyncio.create_task(speculative_render(user, ses))
+
+
+def cancel_speculative(ses: Session):
+    if ses.speculative is not None:
+        ses.speculative.cancel()
+        ses.speculative = None
+    if ses.speculative_job is not None:
+        # 已经被 #结束 提升的任务不能取消
+        if ses.speculative_job.low:
+            render.queue.drop(ses.speculative_job)
+        ses.speculative_job = None
+
+
+async def speculative_render(user: User, ses: Session):
+    await asyncio.sleep(config.SPECULATIVE_DELAY)
+    try:
+        admin = await is_admin(user.user_id)
+        key = image.render_key(user, ses.anonymous, ses.contents, admin)
+        version = ses.version
+        if key == ses.image_key:
+            return
+        await prepare_images(ses)
+        job = await render.queue.submit(
+            user.user_id, render_job(user, ses, admin), low=True, tag=key
+        )
+    except asyncio.QueueFull:
+        return
+    except Exception as e:
+        bot.getLogger().warning(f"预渲染投稿 #{ses.id} 失败: {e}")
+        return
+    ses.speculative_job = job
+    try:
+        if await job.wait() is not None and ses.version == version:
+            ses.image_key = key
+    except Exception as e:
+        bot.getLogger().warning(f"预渲染投稿 #{ses.id} 失败: {e}")
 
 
 @bot.on_cmd("确认", help_msg="用于确认发送当前投稿")
@@ -222,29 +415,34 @@ async def done(msg: PrivateMessage):
         return
 
     session = sessions[msg.sender]
-    if not os.path.isfile(f"./data/{session.id}/image.png"):
+    if not session.previewed or not os.path.isfile(
+        f"./data/{session.id}/image.png"
+    ):
         await msg.reply("请先发送:  \n\n#结束\n\n来查看效果图🤔")
         return
+    cancel_speculative(session)
+    cancel_downloads(session)
+    cancel_expiry(session)
+    image.save_order(session.id, session.contents)
     sessions.pop(msg.sender)
-    article = Article.get_by_id(session.id)
+    journal.record("close", msg.sender.user_id)
+    article = await repo.get_article(session.id)
     anon_text = "匿名" if article.anonymous else ""
     single_text = ", 要求单发" if article.single else ""
-    image_url = get_file_url(f"./data/{session.id}/image.png")
     msg_id = await bot.send_group(
         config.GROUP,
-        f"#{session.id} 用户 {msg.sender} {anon_text}投稿{single_text}\n[CQ:image,file={image_url}]\n* 若同意通过该投稿, 请点击下方表情, 满 2 人同意才会通过.\n  (注意: 取消贴表情不会取消通过的操作)\n* 若要驳回, 请使用 #驳回",
+        f"#{session.id} 用户 {msg.sender} {anon_text}投稿{single_text}\n{image_codes(session.id, 'group')}\n* 若同意通过该投稿, 请点击下方表情, 满 2 人同意才会通过.\n  (注意: 取消贴表情不会取消通过的操作)\n* 若要驳回, 请使用 #驳回",
     )
     await bot.call_api("set_msg_emoji_like", {"message_id": msg_id, "emoji_id": 201})
-    Article.update({"status": Status.CONFRIMED, "tid": msg_id}).where(
-        Article.id == session.id,
-    ).execute()
+    await repo.update_article(session.id, status=Status.CONFRIMED, tid=msg_id)
+    stats.moved(session.id, Status.CONFRIMED)
     await msg.reply(f"已成功投稿, 请耐心等待管理员审核😘\n稿件编号:{session.id}")
 
     await bot.call_api(
         "set_diy_online_status",
         {
             "face_id": random.choice(config.STATUS_ID),
-            "wording": f"已接 {len(Article.select())} 单",
+            "wording": f"已接 {stats.total} 单",
         },
     )
     await update_name()
@@ -257,9 +455,15 @@ async def cancel(msg: PrivateMessage):
         return
 
     id = sessions[msg.sender].id
-    Article.delete_by_id(id)
-    sessions.pop(msg.sender)
-    shutil.rmtree(f"./data/{id}")
+    cancel_speculative(sessions[msg.sender])
+    cancel_downloads(sessions[msg.sender])
+    cancel_expiry(sessions[msg.sender])
+    render.queue.cancel(msg.sender.user_id)
+    if await repo.delete_article(id):
+        stats.removed(id)
+    sessions.pop(msg.sender, None)
+    journal.record("close", msg.sender.user_id)
+    await store.remove(f"./data/{id}")
     await msg.reply("已取消本次投稿🫢")
     await bot.send_group(config.GROUP, f"{msg.sender} 取消了投稿")
 
@@ -313,7 +517,21 @@ async def content(msg: PrivateMessage):
                 continue
             items.append(m)
         if items:
-            session.contents.append(items)
+            reason = session.check(items)
+            if reason is not None:
+                await msg.reply(
+                    f"这条消息没有加入投稿😵‍💫\n一次投稿的{reason}\n可以撤回一些消息, 或者发送 #结束 后再开始新的投稿"
+                )
+                return
+            session.add(msg.message_id, items)
+            journal.record("add", msg.sender.user_id, items=items)
+            session.image_key = None
+            session.previewed = False
+            # 收到图片就开始下载, QQ 的图片链接放久了会过期
+            for m in items:
+                if m["type"] == "image":
+                    start_download(session, m)
+            schedule_speculative(msg.sender, session)
         return
     if agent.is_known_command(raw):
         return  # 已知命令由 @bot.on_cmd 处理, 不进入AI
@@ -327,15 +545,20 @@ async def recall(r: PrivateRecall):
     if not ses:
         return
     bot.getLogger().info(f"用户 {r.user_id} 撤回了一条消息: {r.message_id}")
-    removed = [c for c in ses.contents if c and c[0]["id"] == r.message_id]
-    ses.contents = [c for c in ses.contents if not c or c[0]["id"] != r.message_id]
+    removed = ses.remove(r.message_id)
+    if removed:
+        journal.record("recall", r.user_id, mid=r.message_id)
+        ses.image_key = None
+        ses.previewed = False
+        cancel_speculative(ses)
     print(f"撤回后内容: {ses.contents}")
-    for c in removed:
-        for m in c:
-            if m["type"] == "image":
-                path = f"./data/{ses.id}/{m['data']['file']}"
-                if os.path.isfile(path):
-                    os.remove(path)
+    for m in removed or []:
+        if m["type"] == "image":
+            cancel_downloads(ses, [m["data"]["file"]])
+            await store.unlink(f"./data/{ses.id}/{m['data']['file']}")
+            thumb = f"./data/{ses.id}/thumb/{m['data']['file']}"
+            if os.path.isfile(thumb):
+                os.remove(thumb)
 
 
 # @bot.on_notice()
@@ -349,14 +572,13 @@ async def recall(r: PrivateRecall):
     targets=[config.GROUP],
 )
 async def approve(msg: GroupMessage):
-    async with lock:
-        parts = msg.raw_message.split()
-        if len(parts) < 2:
-            await msg.reply("请带上要通过的投稿编号")
-            return
-        ids = parts[1:]
+    parts = msg.raw_message.split()
+    if len(parts) < 2:
+        await msg.reply("请带上要通过的投稿编号")
+        return
+    ids = parts[1:]
 
-        await approve_article(ids, operator=msg.sender.user_id)
+    await approve_article(ids, operator=msg.sender.user_id)
 
 
 @bot.on_cmd(
@@ -365,31 +587,29 @@ async def approve(msg: GroupMessage):
     targets=[config.GROUP],
 )
 async def refuse(msg: GroupMessage):
-    async with lock:
-        parts = msg.raw_message.split()
-        if len(parts) < 3:
-            await msg.reply("请带上要驳回的投稿和理由")
-            return
+    parts = msg.raw_message.split()
+    if len(parts) < 3:
+        await msg.reply("请带上要驳回的投稿和理由")
+        return
 
-        id = parts[1]
-        reason = parts[2:]
-        article = Article.get_or_none(
-            (Article.id == id) & (Article.status == Status.CONFRIMED)
-        )
-        if article == None:
+    id = parts[1]
+    reason = parts[2:]
+    async with locks.article(id):
+        article = await repo.get_article(id, status=Status.CONFRIMED)
+        if article == None or not await repo.transition(
+            id, Status.CONFRIMED, Status.REJECTED, approve=msg.sender.user_id
+        ):
             await msg.reply(f"投稿 #{id} 不存在或已通过审核")
             return
 
-        Article.update(
-            {"status": Status.REJECTED, "approve": msg.sender.user_id}
-        ).where(Article.id == id).execute()
-        await bot.send_private(
-            article.sender_id,
-            f"抱歉, 你的投稿 #{id} 已被管理员驳回😵‍💫 理由: {' '.join(reason)}",
-        )
-        await msg.reply(f"已驳回投稿 #{id}")
+    stats.moved(article.id, Status.REJECTED)
+    await bot.send_private(
+        article.sender_id,
+        f"抱歉, 你的投稿 #{id} 已被管理员驳回😵‍💫 理由: {' '.join(reason)}",
+    )
+    await msg.reply(f"已驳回投稿 #{id}")
 
-        await update_name()
+    await update_name()
 
 
 @bot.on_cmd(
@@ -398,7 +618,7 @@ async def refuse(msg: GroupMessage):
     targets=[config.GROUP],
 )
 async def push(msg: GroupMessage):
-    async with lock:
+    async with locks.publish():
         parts = msg.raw_message.split()
         if len(parts) < 2:
             await msg.reply("请带上要通过的投稿id")
@@ -406,15 +626,14 @@ async def push(msg: GroupMessage):
 
         ids = parts[1:]
         for id in ids:
-            article = Article.get_or_none(
-                (Article.id == id) & (Article.status == Status.QUEUE)
-            )
+            article = await repo.get_article(id, status=Status.QUEUE)
             if not article:
                 await msg.reply(f"投稿 #{id} 不存在或已被推送或未通过审核")
                 return
         await msg.reply(f"开始推送 {ids}")
         tid = await publish_qzone(ids)
-        await msg.reply(f"已推送 {ids}\ntid: {tid}")
+        if tid:
+            await msg.reply(f"已推送 {ids}\ntid: {tid}")
         await update_name()
 
 
@@ -429,8 +648,9 @@ async def view(msg: GroupMessage):
 
     ids = parts[1:]
     for id in ids:
-        article = Article.get_or_none(Article.id == id)
-        if not article or not os.path.exists(f"./data/{id}/image.png"):
+        article = await repo.get_article(id, archived=True)
+        images = archive.preview(id)
+        if not article or not images:
             await msg.reply(f"投稿 #{id} 不存在")
             return
 
@@ -450,13 +670,12 @@ async def view(msg: GroupMessage):
 
         anon_text = "匿名" if article.anonymous else ""
         single_text = ", 要求单发" if article.single else ""
-        image_url = get_file_url(f"./data/{id}/image.png")
 
         await bot.send_group(
             group=config.GROUP,
             msg=f"[CQ:reply,id={article.tid}]"
             + f"#{id} 用户 {article.sender_name}({article.sender_id}) {anon_text}投稿{single_text}\n"
-            + f"[CQ:image,file={image_url}]\n"
+            + f"{file_codes(images)}\n"
             + f"状态: {status}\n"
             + (
                 ""
@@ -468,10 +687,10 @@ async def view(msg: GroupMessage):
 
 @bot.on_cmd("状态", help_msg="查看队列状态", targets=[config.GROUP])
 async def status(msg: GroupMessage):
-    confirmed = Article.select().where(Article.status == Status.CONFRIMED)
-    queue = Article.select().where(Article.status == Status.QUEUE)
     await msg.reply(
-        f"Nishikigi 已运行 {int(time.time() - start_time)}s\n待审核: {utils.to_list(confirmed)}\n待推送: {utils.to_list(queue)}"
+        f"Nishikigi 已运行 {int(time.time() - start_time)}s\n待审核: {stats.pending()}\n待推送: {stats.queued()}\n"
+        + f"等待投稿锁: {locks.waits['article']}\n等待推送: {locks.waits['publish']}\n"
+        + f"AI 缓存: {agent.cache}"
     )
 
 
@@ -515,67 +734,74 @@ async def reply(msg: GroupMessage):
 async def emoji_approve(notice: EmojiLike):
     if notice.user_id == bot.me.user_id:
         return
-    async with lock:
-        for emoji in notice.likes:
-            if emoji.emoji_id == 201:
-                a = Article.select().where(Article.tid == notice.message_id)
-                if a:
-                    await approve_article(
-                        [a[0].id], operator=notice.user_id, is_emoji=True
-                    )
+    for emoji in notice.likes:
+        if emoji.emoji_id == 201:
+            a = await repo.find_by_tid(notice.message_id)
+            if a:
+                await approve_article([a.id], operator=notice.user_id, is_emoji=True)
 
 
 async def publish_qzone(ids: list[str]) -> list[str]:
-    ids.reverse()
+    """
+    推送到 Qzone, 返回推送了的投稿的 tid. 调用前要先进入 locks.publish(),
+    推送期间这些投稿不能被删除, 已经不在队列中的投稿会被跳过
+    """
+    async with locks.article(*ids):
+        # 等锁期间投稿可能已经被删除或推送, 拿到锁后重新确认, 只推送还在队列中的
+        queued = []
+        for id in ids:
+            if await repo.get_article(id, status=Status.QUEUE):
+                queued.append(id)
+            else:
+                bot.getLogger().warning(f"投稿 #{id} 已经不在待推送队列中, 跳过")
+                await bot.send_group(config.GROUP, f"投稿 #{id} 已被删除或推送, 跳过")
+        ids = queued
+        if not ids:
+            return []
+        ids.reverse()
 
-    qzone = await bot.get_qzone()
-    if len(ids) == 1:
-        folder = f"./data/{ids[0]}"
-        images = [
-            os.path.join(folder, f)
-            for f in os.listdir(folder)
-            if (f.endswith(".png") and f != "image.png")
-        ]
-        images.sort(key=lambda x: os.path.getmtime(x))
-        upload_images = [os.path.join(folder, "image.png")] + images
-        upload_images.reverse()
-        names = [
-            ",".join(
-                await qzone.upload_raw_image(
-                    album_name=config.ALBUM,
-                    file_path=upload_images,
+        qzone = await bot.get_qzone()
+        if len(ids) == 1:
+            upload_images = image.output_paths(ids[0], "upload") + image.raw_images(ids[0])
+            upload_images.reverse()
+            names = [
+                ",".join(
+                    await qzone.upload_raw_image(
+                        album_name=config.ALBUM,
+                        file_path=upload_images,
+                    )
                 )
+            ]
+        else:
+            # 分块的投稿一次上传多张, 和单发一样倒序上传, 相册里才是正序
+            files = [list(reversed(image.output_paths(id, "upload"))) for id in ids]
+            uploaded = await qzone.upload_raw_image(
+                album_name=config.ALBUM,
+                file_path=[f for group in files for f in group],
             )
-        ]
-    else:
-        names = await qzone.upload_raw_image(
-            album_name=config.ALBUM,
-            file_path=list(map(lambda id: f"./data/{id}/image.png", ids)),
-        )
-
-    for i, id in enumerate(ids):
-        Article.update({"tid": names[i], "status": Status.PUBLISHED}).where(
-            Article.id == id
-        ).execute()
-        await bot.send_private(
-            Article.get_by_id(id).sender_id, f"您的投稿 #{id} 已被推送到 Qzone😋"
-        )
-    return names
+            names = []
+            for group in files:
+                names.append(",".join(uploaded[: len(group)]))
+                uploaded = uploaded[len(group) :]
+
+        for i, id in enumerate(ids):
+            if not await repo.transition(
+                id, Status.QUEUE, Status.PUBLISHED, tid=names[i]
+            ):
+                # 不应该发生: 推送期间持有这些投稿的锁
+                bot.getLogger().warning(f"投稿 #{id} 推送后状态已经不是待推送")
+                continue
+            stats.moved(id, Status.PUBLISHED)
+            article = await repo.get_article(id)
+            await bot.send_private(article.sender_id, f"您的投稿 #{id} 已被推送到 Qzone😋")
+        return names
 
 
 async def publish_guild(id: str) -> str:
     guild = await bot.get_guild()
-    folder = f"./data/{id}"
-
-    raw_images = [
-        os.path.join(folder, f)
-        for f in os.listdir(folder)
-        if (f.endswith(".png") and f != "image.png")
-    ]
-    raw_images.sort(key=lambda x: os.path.getmtime(x))
 
-    images = [await guild.upload_image(f"./data/{id}/image.png")]
-    for img in raw_images:
+    images = [await guild.upload_image(p) for p in image.output_paths(id, "upload")]
+    for img in image.raw_images(id):
         images.append(await guild.upload_image(img))
 
     mid = await guild.publish(
@@ -585,53 +811,105 @@ async def publish_guild(id: str) -> str:
         images=images,
     )
 
-    await bot.send_private(
-        Article.get_by_id(id).sender_id, f"您的投稿 #{id} 已被推送到 频道😋"
-    )
-    Article.update({"mid": mid}).where(Article.id == id).execute()
+    article = await repo.get_article(id)
+    await bot.send_private(article.sender_id, f"您的投稿 #{id} 已被推送到 频道😋")
+    await repo.update_article(id, mid=mid)
     return mid
 
 
 async def update_name():
-    confirmed = Article.select().where(Article.status == Status.CONFRIMED)
-    queue = Article.select().where(Article.status == Status.QUEUE)
     await bot.call_api(
         "set_group_card",
         {
             "group_id": config.GROUP,
             "user_id": bot.me.user_id,
-            "card": f"待审核: {utils.to_list(confirmed)}\n待推送: {utils.to_list(queue)}",
+            "card": f"待审核: {stats.pending()}\n待推送: {stats.queued()}",
         },
     )
 
 
-@scheduler.scheduled_job(IntervalTrigger(hours=1))
-async def clear():
-    async with lock:
-        to_remove = []
-        for sess in list(sessions.keys()):
-            try:
-                a = Article.get_by_id(sessions[sess].id)
-            except Exception:
-                continue
-            time_passed = time.time() - a.time.timestamp()
+# 超时处理中的任务, 保留引用防止被回收
+_expiring: set[asyncio.Task] = set()
 
-            if time_passed > 60 * 60:
-                to_remove.append(sess)
-                Article.delete_by_id(a.id)
-                if os.path.exists(f"./data/{a.id}"):
-                    shutil.rmtree(f"./data/{a.id}")
 
-                await bot.send_private(
-                    sess.user_id, f"您的投稿 {a} 因为超时而被自动取消."
-                )
-                await bot.send_group(
-                    config.GROUP, f"用户 {sess.user_id} 的投稿 {a} 因超时而被自动取消."
-                )
-                bot.getLogger().warning(f"取消用户 {sess.user_id} 的投稿 {a}")
+def schedule_expiry(user: User, ses: Session, minimum: float = 0):
+    """在投稿超时的那一刻取消它, 提前 SESSION_WARN 秒提醒用户"""
+    cancel_expiry(ses)
+    loop = asyncio.get_running_loop()
+    delay = max(ses.created + config.SESSION_TIMEOUT - time.time(), minimum)
+    ses.expire_timer = loop.call_later(delay, _spawn, expire, user, ses)
+    if config.SESSION_WARN > 0 and delay > config.SESSION_WARN:
+        ses.warn_timer = loop.call_later(
+            delay - config.SESSION_WARN, _spawn, warn_expiry, user, ses
+        )
+
+
+def cancel_expiry(ses: Session):
+    for timer in (ses.expire_timer, ses.warn_timer):
+        if timer is not None:
+            timer.cancel()
+    ses.expire_timer = None
+    ses.warn_timer = None
 
-        for sess in to_remove:
-            sessions.pop(sess, None)
+
+def _spawn(func, *args):
+    task = asyncio.create_task(func(*args))
+    _expiring.add(task)
+    task.add_done_callback(_expiring.discard)
+
+
+async def warn_expiry(user: User, ses: Session):
+    ses.warn_timer = None
+    if sessions.get(user) is not ses:
+        return
+    await bot.send_private(
+        user.user_id,
+        f"您的投稿 #{ses.id} 还有 {max(config.SESSION_WARN // 60, 1)} 分钟就会因为超时而被自动取消⏰\n"
+        "请尽快发送:  \n\n#结束\n\n和 #确认 完成投稿",
+    )
+
+
+async def expire(user: User, ses: Session):
+    ses.expire_timer = None
+    async with locks.article(ses.id):
+        # 计时器触发前可能已经确认或取消了
+        if sessions.get(user) is not ses:
+            return
+        sessions.pop(user)
+        journal.record("close", user.user_id)
+        cancel_expiry(ses)
+        cancel_speculative(ses)
+        cancel_downloads(ses)
+        render.queue.cancel(user.user_id)
+        if await repo.delete_article(ses.id):
+            stats.removed(ses.id)
+        await store.remove(f"./data/{ses.id}")
+
+    await bot.send_private(user.user_id, f"您的投稿 #{ses.id} 因为超时而被自动取消.")
+    await bot.send_group(
+        config.GROUP, f"用户 {user.user_id} 的投稿 #{ses.id} 因超时而被自动取消."
+    )
+    bot.getLogger().warning(f"取消用户 {user.user_id} 的投稿 #{ses.id}")
+
+
+@scheduler.scheduled_job(IntervalTrigger(seconds=config.STATS_RECONCILE))
+async def reconcile():
+    if stats.apply(*await repo.run(stats.query)):
+        await update_name()
+
+
+@scheduler.scheduled_job(IntervalTrigger(hours=config.ARCHIVE_INTERVAL))
+async def archive_articles():
+    # 只移动已经推送或驳回的投稿, 和其他操作互不影响
+    count = await archive.run()
+    if count:
+        bot.getLogger().info(f"归档了 {count} 个投稿")
+
+
+@scheduler.scheduled_job(IntervalTrigger(minutes=10))
+async def save_agent_cache():
+    # 在事件循环里复制, 线程中遍历 OrderedDict 时可能正被修改
+    await asyncio.to_thread(agent.cache.write, agent.cache.snapshot())
 
 
 @scheduler.scheduled_job(IntervalTrigger(hours=config.HEARTBEAT_INTERVAL))
@@ -692,28 +970,27 @@ async def like(msg: GroupMessage):
     "删除", help_msg="删除一条投稿, 可以删除多条, 如 #删除 1 2", targets=[config.GROUP]
 )
 async def delete(msg: GroupMessage):
-    async with lock:
-        parts = msg.raw_message.split()
-        if len(parts) < 2:
-            await msg.reply("请带上要删除的投稿id")
-            return
+    parts = msg.raw_message.split()
+    if len(parts) < 2:
+        await msg.reply("请带上要删除的投稿id")
+        return
 
-        qzone = await bot.get_qzone()
-        album = await qzone.get_album(config.ALBUM)
-        if album == None:
-            bot.getLogger().error(f"无法找到相册 {config.ALBUM}")
-            return
-        ids = parts[1:]
-        for id in ids:
-            article = Article.get_or_none(
-                (Article.id == id) & (Article.status != Status.CREATED)
-            )
+    qzone = await bot.get_qzone()
+    album = await qzone.get_album(config.ALBUM)
+    if album == None:
+        bot.getLogger().error(f"无法找到相册 {config.ALBUM}")
+        return
+    ids = parts[1:]
+    for id in ids:
+        async with locks.article(id):
+            article = await repo.get_article(id, exclude=Status.CREATED, archived=True)
             if not article:
                 await msg.reply(f"投稿 #{id} 不在队列中")
                 return
-            Article.delete_by_id(id)
-            if os.path.exists(f"./data/{id}"):
-                shutil.rmtree(f"./data/{id}")
+            if await repo.delete_article(id):
+                stats.removed(id)
+            await store.remove(f"./data/{id}")
+            archive.remove(id)
 
             if article.status == Status.PUBLISHED:
                 for i in article.tid.split(","):
@@ -768,9 +1045,16 @@ async def background_img(msg: PrivateMessage):
     for m in msg.message:
         if m["type"] == "image":
             filepath = f"./data/bg/{msg.sender.user_id}.png"
-            await utils.download(
-                m["data"]["url"].replace("https://", "http://"), filepath
-            )
+            try:
+                await utils.download(
+                    m["data"]["url"].replace("https://", "http://"),
+                    filepath,
+                    limit=config.DOWNLOAD_MAX_BYTES,
+                    image=True,
+                )
+            except utils.DownloadError as e:
+                await msg.reply(f"设置背景图失败: {e}")
+                return
             await msg.reply(f"已设置背景图")
             return
 
@@ -783,48 +1067,50 @@ async def friend_request(r: FriendRequest):
 async def approve_article(ids: list, operator: int, is_emoji: bool = False):
     flag = False  # 只有有投稿加入队列时才判断是否推送
     for id in ids:
-        article = Article.get_or_none(
-            (Article.id == id) & (Article.status == Status.CONFRIMED)
-        )
-        if not article:
-            if not is_emoji:
-                await bot.send_group(
-                    group=config.GROUP, msg=f"投稿 #{id} 不存在或已通过审核"
-                )
-            continue
-
-        operators = article.approve.split(",") if article.approve else []
-        if str(operator) in operators:
-            continue
-        operators.append(str(operator))
+        async with locks.article(id):
+            article = await repo.get_article(id, status=Status.CONFRIMED)
+            if not article:
+                if not is_emoji:
+                    await bot.send_group(
+                        group=config.GROUP, msg=f"投稿 #{id} 不存在或已通过审核"
+                    )
+                continue
 
-        Article.update({"approve": ",".join(operators)}).where(
-            Article.id == id
-        ).execute()
+            operators = await repo.approve(id, operator)
+            if operators is None or len(operators) <= 1:
+                continue
 
-        if len(operators) <= 1:
-            continue
+            # 同时有多人通过时只有一个能把投稿移进队列, 其他人到这里就结束
+            operators = list(map(str, operators))
+            if not await repo.transition(
+                id, Status.CONFRIMED, Status.QUEUE, approve=",".join(operators)
+            ):
+                continue
+            stats.moved(id, Status.QUEUE)
 
-        await bot.send_group(
-            config.GROUP, f"投稿 #{id} 进入待发送队列\n审核人: {', '.join(operators)}"
-        )
-        if config.GUILD_ID and config.CHANNEL_ID:
-            await bot.send_group(config.GROUP, f"投稿 #{id} 正在推送到 频道")
-            try:
-                mid = await publish_guild(id)
-                await bot.send_group(
-                    config.GROUP, f"投稿 #{id} 已推送到 频道\nmid: {mid}"
-                )
-            except Exception as e:
-                bot.getLogger().exception(
-                    f"推送投稿 #{id} 到频道失败: {e}", stack_info=True
-                )
-                await bot.send_group(config.GROUP, f"投稿 #{id} 推送失败: {e}")
+            await bot.send_group(
+                config.GROUP, f"投稿 #{id} 进入待发送队列\n审核人: {', '.join(operators)}"
+            )
+            if config.GUILD_ID and config.CHANNEL_ID:
+                await bot.send_group(config.GROUP, f"投稿 #{id} 正在推送到 频道")
+                try:
+                    mid = await publish_guild(id)
+                    await bot.send_group(
+                        config.GROUP, f"投稿 #{id} 已推送到 频道\nmid: {mid}"
+                    )
+                except Exception as e:
+                    bot.getLogger().exception(
+                        f"推送投稿 #{id} 到频道失败: {e}", stack_info=True
+                    )
+                    await bot.send_group(config.GROUP, f"投稿 #{id} 推送失败: {e}")
 
         if article.single:
-            await bot.send_group(group=config.GROUP, msg=f"开始推送 #{id}")
-            await publish_qzone([id])
-            await bot.send_group(group=config.GROUP, msg=f"投稿 #{id} 已经单发")
+            # 等待推送期间投稿在队列中, 可能已经被 #推送 推送过了.
+            # publish_qzone 会在上传前重新确认状态, 这时什么都不做
+            async with locks.publish():
+                await bot.send_group(group=config.GROUP, msg=f"开始推送 #{id}")
+                if await publish_qzone([id]):
+                    await bot.send_group(group=config.GROUP, msg=f"投稿 #{id} 已经单发")
             continue
         else:
             await bot.send_private(
@@ -832,32 +1118,25 @@ async def approve_article(ids: list, operator: int, is_emoji: bool = False):
                 f"您的投稿 {article} 已通过审核, 正在队列中等待发送",
             )
         flag = True
-        Article.update(
-            {
-                "status": Status.QUEUE,
-            }
-        ).where(Article.id == id).execute()
 
     if flag:
-        articles = (
-            Article.select()
-            .where(Article.status == Status.QUEUE)
-            .order_by(Article.id.asc())
-            .limit(config.QUEUE)
-        )
-        if len(articles) < config.QUEUE:
-            await bot.send_group(
-                group=config.GROUP, msg=f"当前队列中有{len(articles)}个稿件, 暂不推送"
-            )
-        else:
-            await bot.send_group(
-                group=config.GROUP,
-                msg=f"队列已积压{len(articles)}个稿件, 将推送前{config.QUEUE}个稿件...",
-            )
-            tid = await publish_qzone(list(map(lambda a: a.id, articles)))
-            await bot.send_group(
-                group=config.GROUP,
-                msg=f"已推送{list(map(lambda a: a.id, articles))}\ntid: {tid}",
-            )
+        # 推送要排队, 否则两次通过可能同时推送同一批投稿
+        async with locks.publish():
+            articles = await repo.queued_articles(config.QUEUE)
+            if len(articles) < config.QUEUE:
+                await bot.send_group(
+                    group=config.GROUP,
+                    msg=f"当前队列中有{len(articles)}个稿件, 暂不推送",
+                )
+            else:
+                await bot.send_group(
+                    group=config.GROUP,
+                    msg=f"队列已积压{len(articles)}个稿件, 将推送前{config.QUEUE}个稿件...",
+                )
+                tid = await publish_qzone(list(map(lambda a: a.id, articles)))
+                await bot.send_group(
+                    group=config.GROUP,
+                    msg=f"已推送{list(map(lambda a: a.id, articles))}\ntid: {tid}",
+                )
 
     await update_name()
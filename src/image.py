@@ -1,11 +1,84 @@
+import asyncio
+import base64
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from dataclasses import dataclass
 from datetime import datetime
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import shutil
+import time
+from typing import Awaitable
+from urllib.parse import unquote, urlsplit
 
 from botx.models import User
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 import playwright.async_api
-from PIL import Image
+from PIL import Image, ImageOps
 
+import config
+import draw
+import utils
+
+# 渲染页面所在的虚拟源, 页面和本地图片都由路由拦截直接返回, 不落盘
+ORIGIN = "http://nishikigi.render"
+# 渲染页面允许读取的本地目录
+LOCAL_ROOTS = [os.path.abspath("./data"), os.path.abspath("./face")]
+# 截图右侧和底部裁掉的像素数 (设备像素)
+CROP = 64
+SCALE = config.RENDER_SCALE
+
+
+# 消息中图片的最大显示宽度, 表情包的显示高度 (CSS 像素), 和 normal.html 保持一致
+IMAGE_WIDTH = 360
+STICKER_HEIGHT = 240
+
+# 纯文字投稿使用的字体, 找不到时全部交给 Chromium
+FONT = draw.find_font(config.FONT_PATH, draw.FONT_CANDIDATES)
+FONT_BOLD = draw.find_font(config.FONT_BOLD_PATH, draw.BOLD_CANDIDATES)
+
+# 找不到对应的 QQ 表情时显示的文字
+FACE_FALLBACK = "[表情]"
+
+# 图片缩放放在子进程里, 不占用事件循环. 用 fork 避免子进程重新执行 main.py
+process_pool = ProcessPoolExecutor(
+    max_workers=config.IMAGE_WORKERS, mp_context=multiprocessing.get_context("fork")
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Profile:
+    format: str
+    quality: int
+    scale: float
+
+    @classmethod
+    def parse(cls, value: str) -> "Profile":
+        format, quality, scale = value.lower().split(":")
+        if format == "jpg":
+            format = "jpeg"
+        if format not in ("png", "webp", "jpeg"):
+            raise ValueError(f"不支持的图片格式: {format}")
+        return cls(format=format, quality=int(quality), scale=float(scale))
+
+    @property
+    def lossless(self) -> bool:
+        """和存档图完全一致, 不需要另外编码"""
+        return self.format == "png" and self.scale == 1
+
+    @property
+    def extension(self) -> str:
+        return "jpg" if self.format == "jpeg" else self.format
+
+
+PROFILES = {
+    "preview": Profile.parse(config.IMAGE_PREVIEW),
+    "group": Profile.parse(config.IMAGE_GROUP),
+    "upload": Profile.parse(config.IMAGE_UPLOAD),
+}
 
 env = Environment(
     loader=FileSystemLoader("templates"),
@@ -15,9 +88,156 @@ env = Environment(
 )
 
 
-async def generate_img(
-    id: int, user: User, anonymous: bool, contents: list, admin: bool = False
-) -> str:
+@dataclass(frozen=True, slots=True)
+class Face:
+    # PNG 的内容, Pillow 直接绘制时使用
+    data: bytes
+    uri: str
+
+
+faces: dict[str, Face] = {}
+
+
+def load_faces(folder: str = "./face") -> int:
+    """启动时把 QQ 表情全部读入内存, 渲染时直接内联成 data URI, 返回表情数量"""
+    faces.clear()
+    for name in os.listdir(folder):
+        face_id, ext = os.path.splitext(name)
+        if ext != ".png":
+            continue
+        path = os.path.abspath(os.path.join(folder, name))
+        try:
+            with open(path, mode="rb") as f:
+                data = f.read()
+            with Image.open(io.BytesIO(data)) as img:
+                img.verify()
+        except Exception as e:
+            from core import bot
+
+            bot.getLogger().warning(f"无法读取表情 {path}: {e}")
+            continue
+        faces[face_id] = Face(
+            data=data,
+            uri="data:image/png;base64," + base64.b64encode(data).decode(),
+        )
+    return len(faces)
+
+
+def save_order(id: int, contents: list):
+    """记录投稿图片的发送顺序, 上传原图时按这个顺序"""
+    files = []
+    for items in contents:
+        for d in items:
+            if d["type"] == "image" and d["data"]["file"] not in files:
+                files.append(d["data"]["file"])
+    with open(f"./data/{id}/images.json", mode="w", encoding="utf-8") as f:
+        json.dump(files, f)
+
+
+def raw_images(id: int | str) -> list[str]:
+    """
+    投稿者发送的原图. 图片是仓库中的硬链接, 修改时间不代表发送顺序,
+    所以优先使用 images.json 中记录的顺序
+    """
+    folder = f"./data/{id}"
+    order = os.path.join(folder, "images.json")
+    if os.path.isfile(order):
+        with open(order, encoding="utf-8") as f:
+            files = json.load(f)
+        return [
+            os.path.join(folder, f)
+            for f in files
+            if f.endswith(".png")
+            and f != "image.png"
+            and os.path.isfile(os.path.join(folder, f))
+        ]
+    images = [
+        os.path.join(folder, f)
+        for f in os.listdir(folder)
+        if (f.endswith(".png") and f != "image.png")
+    ]
+    images.sort(key=lambda x: os.path.getmtime(x))
+    return images
+
+
+def _thumb_path(id: int, segment: dict) -> str:
+    return os.path.abspath(f"./data/{id}/thumb/{segment["data"]["file"]}")
+
+
+def render_file(id: int, segment: dict) -> str:
+    """渲染时使用的图片, 有缩小后的副本就用副本, 原图留给 QQ 空间上传"""
+    thumb = _thumb_path(id, segment)
+    if os.path.isfile(thumb):
+        return thumb
+    return os.path.abspath(f"./data/{id}/{segment["data"]["file"]}")
+
+
+async def prepare(id: int, segment: dict):
+    """为图片生成渲染尺寸的副本, 图片本来就不大时不生成"""
+    src = os.path.abspath(f"./data/{id}/{segment["data"]["file"]}")
+    dst = _thumb_path(id, segment)
+    if not os.path.isfile(src) or os.path.isfile(dst):
+        return
+    sticker = segment["data"].get("sub_type") == 1
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            process_pool, _downscale, src, dst, sticker, SCALE
+        )
+    except Exception as e:
+        # 副本只是优化, 失败了就用原图渲染
+        from core import bot
+
+        bot.getLogger().warning(f"缩小图片 {src} 失败: {e}")
+
+
+def _downscale(src: str, dst: str, sticker: bool, scale: float):
+    with Image.open(src) as img:
+        jpeg = img.format == "JPEG"
+        img = ImageOps.exif_transpose(img)
+        w, h = img.size
+        if sticker:
+            factor = STICKER_HEIGHT * scale / h
+        else:
+            factor = IMAGE_WIDTH * scale / w
+        if factor >= 1:
+            return
+        format = "JPEG" if jpeg or img.mode == "RGB" else "PNG"
+        if format == "PNG" and img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA")
+        out = img.resize(
+            (max(1, round(w * factor)), max(1, round(h * factor))),
+            Image.Resampling.LANCZOS,
+        )
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.tmp"
+        out.save(tmp, format=format, quality=90)
+        os.replace(tmp, dst)
+
+
+def render_key(user: User, anonymous: bool, contents: list, admin: bool) -> str:
+    """预览图的缓存键, 任何会影响渲染结果的输入变了, 键都会变"""
+    bg = f"./data/bg/{user.user_id}.png"
+    bg_stat = os.stat(bg) if os.path.exists(bg) else None
+    # 头像没下载到时用的是占位图, 下载到以后要重新渲染
+    avatar = os.path.isfile(_avatar(10000 if anonymous else user.user_id)[1])
+    payload = json.dumps(
+        {
+            "avatar": avatar,
+            "contents": contents,
+            "user": [user.user_id, user.nickname],
+            "anonymous": anonymous,
+            "admin": admin,
+            "bg": [bg_stat.st_mtime_ns, bg_stat.st_size] if bg_stat else None,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def template_contents(id: int, contents: list) -> list[list[str]]:
+    """把投稿内容转换成 normal.html 使用的格式"""
     _contents = []
     for items in contents:
         values = [
@@ -28,15 +248,9 @@ async def generate_img(
                 case "image":
                     if d["data"]["sub_type"] == 1:
                         # 表情包
-                        values.append(
-                            "_file://"
-                            + os.path.abspath(f"./data/{id}/{d["data"]["file"]}")
-                        )
+                        values.append("_file://" + render_file(id, d))
                     else:
-                        values.append(
-                            "file://"
-                            + os.path.abspath(f"./data/{id}/{d["data"]["file"]}")
-                        )
+                        values.append("file://" + render_file(id, d))
                 case "text":
                     values.append(
                         d["data"]["text"]
@@ -44,10 +258,18 @@ async def generate_img(
                         .replace("\n", "__internal_br__")
                     )
                 case "face":
+                    face = faces.get(str(d["data"]["id"]))
                     values.append(
-                        "face://" + os.path.abspath(f"./face/{d["data"]["id"]}.png")
+                        "face://" + face.uri if face is not None else FACE_FALLBACK
                     )
         _contents.append(values)
+    return _contents
+
+
+async def generate_img(
+    id: int, user: User, anonymous: bool, contents: list, admin: bool = False
+) -> str:
+    _contents = template_contents(id, contents)
     # if user != None:
     #     url = f"https://3lu.cn/qq.php?qq={user.user_id}"
     #     qr = qrcode.QRCode(border=0)
@@ -55,55 +277,498 @@ async def generate_img(
     #     img = qr.make_image(back_color="#f0f0f0")
     #     img.save(f"./data/{id}/qrcode.png")  # type: ignore
 
-    output = env.get_template("normal.html").render(
-        contents=_contents,
-        date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        username=user.nickname,
-        user_id=user.user_id,
-        # qrcode=os.path.abspath(f"./data/{id}/qrcode.png") if user else None,
-        admin=admin,
-        id=id,
-        anonymous=anonymous,
-        bg_img=(
-            os.path.abspath(f"./data/bg/{user.user_id}.png")
-            if os.path.exists(f"./data/bg/{user.user_id}.png")
-            else None
-        ),
+    avatar = await fetch_avatar(10000 if anonymous else user.user_id)
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    bg_img = (
+        os.path.abspath(f"./data/bg/{user.user_id}.png")
+        if os.path.exists(f"./data/bg/{user.user_id}.png")
+        else None
     )
-    with open(f"./data/{id}/page.html", mode="w", encoding="utf-8") as f:
-        f.write(output)
-    tmp_file = f"./data/{id}/tmp.png"
-
-    await screenshoot(id=id, output_path=tmp_file)
+    path = os.path.abspath(f"./data/{id}/image.png")
+    # 先渲染到这次任务自己的目录, 没被取消才换进投稿文件夹
+    root = os.path.abspath(f"./data/{id}/.render-{os.urandom(4).hex()}")
+    token = _latest[id] = object()
     try:
-        with Image.open(tmp_file) as img:
-            # 定义裁切区域 (left, upper, right, lower), 左上角为 (0,0)
-            crop_box = (0, 0, img.size[0] - 64, img.size[1] - 64)
-            cropped_img = img.crop(crop_box)
-            cropped_img.save(f"./data/{id}/image.png")
-    finally:
-        if os.path.exists(tmp_file):
-            os.remove(tmp_file)
-    return os.path.abspath(f"./data/{id}/image.png")
+        if FONT is not None and is_simple(contents):
+            spec = dict(
+                id=id,
+                messages=[_simple_items(items) for items in contents],
+                username=user.nickname,
+                user_id=user.user_id,
+                anonymous=anonymous,
+                admin=admin,
+                date=date,
+                avatar=avatar,
+                bg_img=bg_img,
+                font_path=FONT,
+                bold_path=FONT_BOLD,
+                scale=SCALE,
+                crop=CROP,
+            )
+            try:
+                await _wait_worker(
+                    asyncio.get_running_loop().run_in_executor(
+                        process_pool, _draw_fast, root, spec, config.RENDER_TILE_HEIGHT
+                    ),
+                    root,
+                )
+                _swap(id, root, token)
+                return path
+            except Exception as e:
+                from core import bot
 
+                bot.getLogger().warning(
+                    f"快速绘制投稿 #{id} 失败, 改用 Chromium: {e}"
+                )
+                shutil.rmtree(root, ignore_errors=True)
 
-async def screenshoot(id: int, output_path: str):
-    async with playwright.async_api.async_playwright() as p:
-        browser = await p.chromium.launch(headless=True, chromium_sandbox=True)
-        try:
-            page = await browser.new_page(
-                viewport={"width": 720, "height": 720},
-                device_scale_factor=3,
+        output = env.get_template("normal.html").render(
+            avatar=avatar,
+            contents=_contents,
+            date=date,
+            username=user.nickname,
+            user_id=user.user_id,
+            # qrcode=os.path.abspath(f"./data/{id}/qrcode.png") if user else None,
+            admin=admin,
+            id=id,
+            anonymous=anonymous,
+            bg_img=bg_img,
+        )
+        tiles = await screenshoot(output, config.RENDER_TILE_HEIGHT)
+        os.makedirs(root, exist_ok=True)
+        if len(tiles) == 1:
+            with open(_staged(root), mode="wb") as f:
+                f.write(tiles[0])
+            await _wait_worker(asyncio.to_thread(_encode_png, root, tiles[0]), root)
+        else:
+            os.makedirs(os.path.join(root, "tiles"), exist_ok=True)
+            for i, data in enumerate(tiles):
+                with open(_staged(root, i), mode="wb") as f:
+                    f.write(data)
+            # image.png 用第一块, 其他地方照常判断预览图是否存在
+            shutil.copyfile(_staged(root, 0), _staged(root))
+            await _wait_worker(
+                asyncio.gather(
+                    *(
+                        asyncio.to_thread(_encode_png, root, data, i)
+                        for i, data in enumerate(tiles)
+                    )
+                ),
+                root,
             )
-            await page.goto(
-                f"file://{os.path.abspath(f"./data/{id}/page.html")}",
-                wait_until="networkidle",
+        _swap(id, root, token)
+        return path
+    finally:
+        if _latest.get(id) is token:
+            del _latest[id]
+        if root not in _orphans:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+# 投稿 id -> 最近一次开始的渲染, 只有它的结果能换进投稿文件夹
+_latest: dict[int, object] = {}
+# 任务已经取消, 但线程或子进程还在往里写的临时目录
+_orphans: set[str] = set()
+
+
+async def _wait_worker(work: Awaitable, root: str):
+    """
+    等待线程或子进程中的渲染. 取消时它们停不下来,
+    等写完再删掉临时目录, 不会写到别的渲染的文件里
+    """
+    fut = asyncio.ensure_future(work)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        if not fut.done():
+            _orphans.add(root)
+            fut.add_done_callback(lambda f: _discard_orphan(root, f))
+        raise
+
+
+def _discard_orphan(root: str, fut: asyncio.Future):
+    if not fut.cancelled():
+        fut.exception()
+    _orphans.discard(root)
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def _swap(id: int, root: str, token: object):
+    """把临时目录中的结果换进投稿文件夹, 已经有更新的渲染开始时放弃这次的结果"""
+    if _latest.get(id) is not token:
+        raise asyncio.CancelledError()
+    _reset_outputs(id)
+    for folder in ("tiles", "render"):
+        if os.path.isdir(os.path.join(root, folder)):
+            os.replace(os.path.join(root, folder), f"./data/{id}/{folder}")
+    os.replace(_staged(root), _archive(id))
+
+
+def _cuts(height: float, tops: list[float], tile: float) -> list[tuple[float, float]]:
+    """在消息之间切开, 每块不超过 tile. 单条消息比 tile 还高时只能从中间切"""
+    if tile <= 0 or height <= tile:
+        return [(0, height)]
+    cuts = []
+    start = 0.0
+    while height - start > tile:
+        candidates = [t for t in tops if start < t <= start + tile]
+        end = max(candidates) if candidates else start + tile
+        cuts.append((start, end))
+        start = end
+    cuts.append((start, height))
+    return cuts
+
+
+def _reset_outputs(id: int):
+    for folder in ("tiles", "render"):
+        if os.path.isdir(f"./data/{id}/{folder}"):
+            shutil.rmtree(f"./data/{id}/{folder}")
+
+
+def _staged(root: str, index: int | None = None) -> str:
+    if index is None:
+        return os.path.join(root, "image.png")
+    return os.path.join(root, "tiles", f"{index}.png")
+
+
+def _archive(id: int | str, index: int | None = None) -> str:
+    if index is None:
+        return os.path.abspath(f"./data/{id}/image.png")
+    return os.path.abspath(f"./data/{id}/tiles/{index}.png")
+
+
+def tile_count(id: int | str) -> int:
+    folder = f"./data/{id}/tiles"
+    if not os.path.isdir(folder):
+        return 0
+    return len([f for f in os.listdir(folder) if f.endswith(".png")])
+
+
+def is_simple(contents: list) -> bool:
+    """只有文字和 QQ 表情的投稿可以不用 Chromium"""
+    if not config.FAST_RENDER:
+        return False
+    for items in contents:
+        for d in items:
+            if d["type"] == "text":
+                if not draw.supports_text(d["data"]["text"]):
+                    return False
+            elif d["type"] != "face":
+                return False
+    return True
+
+
+def _simple_items(items: list) -> list[tuple[str, str | bytes | None]]:
+    result: list[tuple[str, str | bytes | None]] = []
+    for d in items:
+        if d["type"] == "text":
+            result.append(("text", d["data"]["text"]))
+        else:
+            face = faces.get(str(d["data"]["id"]))
+            if face is not None:
+                result.append(("face", face.data))
+            else:
+                result.append(("text", FACE_FALLBACK))
+    return result
+
+
+def _draw_fast(root: str, spec: dict, tile: int):
+    """在子进程中执行, 结果写到 root"""
+    img, tops = draw.draw_card(**spec)
+    os.makedirs(root, exist_ok=True)
+    cuts = _cuts(img.height, tops, tile * spec["scale"])
+    # 存档图只求快, 压缩交给各用途的输出
+    if len(cuts) == 1:
+        img.save(_staged(root), format="PNG", compress_level=1)
+        _encode_outputs(root, img)
+        return
+    os.makedirs(os.path.join(root, "tiles"), exist_ok=True)
+    for i, (start, end) in enumerate(cuts):
+        part = img.crop((0, round(start), img.width, round(end)))
+        part.save(_staged(root, i), format="PNG", compress_level=1)
+        _encode_outputs(root, part, i)
+    shutil.copyfile(_staged(root, 0), _staged(root))
+
+
+def output_path(id: int | str, profile: str, index: int | None = None) -> str:
+    """某个用途对应的图片, 没有单独编码时使用存档图. index 为分块序号"""
+    p = PROFILES[profile]
+    suffix = "" if index is None else f"-{index}"
+    path = os.path.abspath(f"./data/{id}/render/{profile}{suffix}.{p.extension}")
+    if p.lossless or not os.path.isfile(path):
+        return _archive(id, index)
+    return path
+
+
+def output_paths(id: int | str, profile: str) -> list[str]:
+    """预览图的全部分块, 按从上到下的顺序"""
+    count = tile_count(id)
+    if count == 0:
+        return [output_path(id, profile)]
+    return [output_path(id, profile, i) for i in range(count)]
+
+
+def _encode_png(root: str, data: bytes, index: int | None = None):
+    if all(p.lossless for p in PROFILES.values()):
+        return
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        _encode_outputs(root, img, index)
+
+
+def _encode_outputs(root: str, img: Image.Image, index: int | None = None):
+    profiles = {name: p for name, p in PROFILES.items() if not p.lossless}
+    if not profiles:
+        return
+    os.makedirs(os.path.join(root, "render"), exist_ok=True)
+    suffix = "" if index is None else f"-{index}"
+    resized: dict[float, Image.Image] = {1: img}
+    for name, p in profiles.items():
+        if p.scale not in resized:
+            resized[p.scale] = img.resize(
+                (round(img.width * p.scale), round(img.height * p.scale)),
+                Image.Resampling.LANCZOS,
             )
-            await page.screenshot(
-                type="png",
-                full_page=True,
-                path=output_path,
-                animations="disabled",
+        out = resized[p.scale]
+        if p.format == "jpeg" and out.mode != "RGB":
+            out = out.convert("RGB")
+        out.save(
+            os.path.join(root, "render", f"{name}{suffix}.{p.extension}"),
+            format=p.format.upper(),
+            quality=p.quality,
+            optimize=True,
+        )
+
+
+# 正在下载的缓存文件, 同一个文件同时只下载一次
+_downloading: dict[str, asyncio.Task] = {}
+
+
+async def _download_cached(url: str, path: str, timeout: float) -> bool:
+    tmp = f"{path}.{os.urandom(4).hex()}.tmp"
+    try:
+        await utils.download(
+            url, tmp, limit=config.DOWNLOAD_MAX_BYTES, timeout=timeout
+        )
+        os.replace(tmp, path)
+        return True
+    except Exception as e:
+        from core import bot
+
+        bot.getLogger().warning(f"下载 {url} 失败: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+def _download_later(url: str, path: str, timeout: float) -> asyncio.Task:
+    task = _downloading.get(path)
+    if task is None:
+        task = asyncio.create_task(_download_cached(url, path, timeout))
+        _downloading[path] = task
+        task.add_done_callback(lambda _: _downloading.pop(path, None))
+    return task
+
+
+async def cached(url: str, path: str, ttl: int, timeout: float) -> str | None:
+    """
+    把远程文件缓存到 path. 有缓存时直接使用, 过期了在后台重新下载.
+    没有缓存时最多等待 timeout 秒, 下载失败返回 None
+    """
+    if os.path.isfile(path):
+        if time.time() - os.path.getmtime(path) >= ttl:
+            _download_later(url, path, timeout)
+        return os.path.abspath(path)
+    # 等待的渲染被取消时不影响下载本身
+    await asyncio.shield(_download_later(url, path, timeout))
+    return os.path.abspath(path) if os.path.isfile(path) else None
+
+
+def _avatar(user_id: int) -> tuple[str, str]:
+    return (
+        f"https://q1.qlogo.cn/g?b=qq&nk={user_id}&s=100",
+        f"./data/avatar/{user_id}.png",
+    )
+
+
+async def fetch_avatar(user_id: int) -> str | None:
+    """没有缓存时最多等 AVATAR_TIMEOUT 秒, 还下载不到就用占位图"""
+    return await cached(*_avatar(user_id), config.AVATAR_TTL, config.AVATAR_TIMEOUT)
+
+
+def prefetch_avatar(user_id: int):
+    """开始投稿时就在后台下载头像, 渲染时一般已经有缓存了"""
+    url, path = _avatar(user_id)
+    if (
+        not os.path.isfile(path)
+        or time.time() - os.path.getmtime(path) >= config.AVATAR_TTL
+    ):
+        _download_later(url, path, config.AVATAR_TIMEOUT)
+
+
+async def _serve(route: playwright.async_api.Route):
+    url = urlsplit(route.request.url)
+    if f"{url.scheme}://{url.netloc}" != ORIGIN:
+        # 其他远程资源也从本地缓存读取, 不让渲染等外部网络
+        path = None
+        if url.scheme in ("http", "https") and route.request.method == "GET":
+            key = hashlib.sha256(route.request.url.encode()).hexdigest()
+            path = await cached(
+                route.request.url,
+                f"./data/cache/{key}",
+                config.ASSET_TTL,
+                config.ASSET_TIMEOUT,
             )
+        if path is None:
+            await route.abort()
+        else:
+            await route.fulfill(path=path)
+        return
+    if url.path == "/":
+        await route.fulfill(body="", content_type="text/html; charset=utf-8")
+        return
+    path = os.path.abspath(unquote(url.path))
+    if os.path.isfile(path) and any(
+        os.path.commonpath([path, root]) == root for root in LOCAL_ROOTS
+    ):
+        await route.fulfill(path=path)
+    else:
+        await route.fulfill(status=404)
+
+
+@dataclass(slots=True)
+class _Slot:
+    page: playwright.async_api.Page | None = None
+    uses: int = 0
+    generation: int = 0
+
+
+class BrowserPool:
+    """常驻的 Chromium, 页面轮流复用, 避免每次渲染都冷启动浏览器"""
+
+    def __init__(self, size: int, recycle: int):
+        self.size = size
+        self.recycle = recycle
+        self._playwright: playwright.async_api.Playwright | None = None
+        self._browser: playwright.async_api.Browser | None = None
+        self._generation = 0
+        self._slots: asyncio.Queue[_Slot] = asyncio.Queue()
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        self._playwright = await playwright.async_api.async_playwright().start()
+        await self._launch()
+        for _ in range(self.size):
+            self._slots.put_nowait(_Slot())
+
+    async def stop(self):
+        if self._browser is not None:
+            with contextlib.suppress(Exception):
+                await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _launch(self):
+        assert self._playwright is not None, "浏览器池尚未启动"
+        self._browser = await self._playwright.chromium.launch(
+            headless=True, chromium_sandbox=True
+        )
+        # 旧浏览器上创建的页面全部作废
+        self._generation += 1
+
+    async def _ensure_browser(self):
+        async with self._lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            from core import bot
+
+            bot.getLogger().warning("Chromium 已断开, 正在重启")
+            if self._browser is not None:
+                with contextlib.suppress(Exception):
+                    await self._browser.close()
+            await self._launch()
+
+    async def _discard(self, slot: _Slot):
+        if slot.page is not None:
+            with contextlib.suppress(Exception):
+                await slot.page.context.close()
+        slot.page = None
+        slot.uses = 0
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        slot = await self._slots.get()
+        try:
+            await self._ensure_browser()
+            if (
+                slot.page is None
+                or slot.generation != self._generation
+                or slot.page.is_closed()
+            ):
+                await self._discard(slot)
+                assert self._browser is not None
+                context = await self._browser.new_context(
+                    viewport={"width": 720, "height": 720},
+                    device_scale_factor=SCALE,
+                )
+                slot.page = await context.new_page()
+                # 先打开虚拟源下的空白页, 之后 set_content 写入的页面就能加载本地图片
+                await slot.page.route("**/*", _serve)
+                await slot.page.goto(f"{ORIGIN}/")
+                slot.generation = self._generation
+            try:
+                yield slot.page
+            except Exception:
+                # 页面状态未知, 直接丢弃; 如果是浏览器崩溃, 下次取用时会重启
+                await self._discard(slot)
+                raise
+            slot.uses += 1
+            if slot.uses >= self.recycle:
+                await self._discard(slot)
         finally:
-            await browser.close()
+            self._slots.put_nowait(slot)
+
+
+browser = BrowserPool(size=config.RENDER_PAGES, recycle=config.RENDER_RECYCLE)
+
+
+async def screenshoot(html: str, tile: int = 0) -> list[bytes]:
+    """截图, tile 大于 0 时在消息之间切成不超过 tile (CSS 像素) 高的多张"""
+    async with browser.page() as page:
+        await page.set_content(html, wait_until="load")
+        # 所有资源都在本地, 等图片解码和字体就绪即可, 不必等 networkidle
+        await page.evaluate(
+            """() => Promise.all([
+                document.fonts.ready,
+                ...Array.from(document.images, img => img.decode().catch(() => {})),
+            ])"""
+        )
+        width, height, tops = await page.evaluate(
+            """() => {
+                const b = document.body, e = document.documentElement;
+                return [
+                    Math.max(b.scrollWidth, e.scrollWidth, b.offsetWidth, e.offsetWidth, b.clientWidth, e.clientWidth),
+                    Math.max(b.scrollHeight, e.scrollHeight, b.offsetHeight, e.offsetHeight, b.clientHeight, e.clientHeight),
+                    Array.from(document.querySelectorAll(".message"), m => m.getBoundingClientRect().top + window.scrollY),
+                ];
+            }"""
+        )
+        # 直接在截图时裁切, 不再经过 Pillow 重新编码
+        tiles = []
+        for start, end in _cuts(height - CROP / SCALE, tops, tile):
+            tiles.append(
+                await page.screenshot(
+                    type="png",
+                    full_page=True,
+                    clip={
+                        "x": 0,
+                        "y": start,
+                        "width": width - CROP / SCALE,
+                        "height": end - start,
+                    },
+                    animations="disabled",
+                )
+            )
+        return tiles
@@ -0,0 +1,165 @@
+"""
+投稿会话的日志. 会话的每次变化追加一行 JSON 到 data/sessions.jsonl,
+攒一批再由后台任务写入, 重启后重放日志恢复未结束的投稿.
+日志只记录还没结束的会话, 启动时和行数过多时会压缩成一份快照.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import config
+
+PATH = "./data/sessions.jsonl"
+
+# user_id -> {"name", "id", "anonymous", "time", "contents": {消息 id: 内容}}
+_state: dict[int, dict] = {}
+_buffer: list[dict] = []
+_lines = 0
+_wakeup = asyncio.Event()
+_task: asyncio.Task | None = None
+_closing = False
+
+
+def _apply(entry: dict):
+    user = entry["user"]
+    match entry["op"]:
+        case "open":
+            _state[user] = {
+                "name": entry["name"],
+                "id": entry["id"],
+                "anonymous": entry["anonymous"],
+                "time": entry.get("time"),
+                "contents": {},
+            }
+        case "add":
+            if user in _state:
+                _state[user]["contents"][entry["items"][0]["id"]] = entry["items"]
+        case "recall":
+            if user in _state:
+                _state[user]["contents"].pop(entry["mid"], None)
+        case "close":
+            _state.pop(user, None)
+
+
+def _snapshot() -> list[dict]:
+    entries = []
+    for user, s in _state.items():
+        entries.append(
+            {
+                "op": "open",
+                "user": user,
+                "name": s["name"],
+                "id": s["id"],
+                "anonymous": s["anonymous"],
+                "time": s["time"],
+            }
+        )
+        entries.extend({"op": "add", "user": user, "items": c} for c in s["contents"].values())
+    return entries
+
+
+def _compact(entries: list[dict]):
+    global _lines
+    tmp = f"{PATH}.tmp"
+    with open(tmp, mode="w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, PATH)
+    _lines = len(entries)
+
+
+def load() -> dict[int, dict]:
+    """重放日志, 返回未结束的会话, 并把日志压缩成快照"""
+    from core import bot
+
+    _state.clear()
+    start = time.perf_counter()
+    count = 0
+    if os.path.isfile(PATH):
+        with open(PATH, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半
+                    bot.getLogger().warning(f"跳过无法解析的日志: {line!r}")
+                    continue
+                _apply(entry)
+                count += 1
+    _compact(_snapshot())
+    bot.getLogger().info(
+        f"重放了 {count} 条会话日志, 恢复 {len(_state)} 个会话, "
+        f"用时 {time.perf_counter() - start:.2f}s"
+    )
+    return {
+        user: {**s, "contents": list(s["contents"].values())}
+        for user, s in _state.items()
+    }
+
+
+def record(op: str, user: int, **data):
+    """记录一次变化, 不等待写入"""
+    entry = {"op": op, "user": user, **data}
+    _apply(entry)
+    _buffer.append(entry)
+    _wakeup.set()
+
+
+def _write(entries: list[dict]):
+    with open(PATH, mode="a", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def flush():
+    global _lines
+    if not _buffer:
+        return
+    entries = _buffer.copy()
+    _buffer.clear()
+    try:
+        if _lines + len(entries) > config.JOURNAL_COMPACT:
+            await asyncio.to_thread(_compact, _snapshot())
+        else:
+            await asyncio.to_thread(_write, entries)
+            _lines += len(entries)
+    except Exception:
+        # 放回去下次再写
+        _buffer[:0] = entries
+        raise
+
+
+async def _writer():
+    while not _closing:
+        await _wakeup.wait()
+        if not _closing:
+            # 等一会儿, 把这段时间的变化合成一次写入
+            await asyncio.sleep(config.JOURNAL_FLUSH)
+        _wakeup.clear()
+        try:
+            await flush()
+        except Exception as e:
+            from core import bot
+
+            bot.getLogger().exception(f"写入会话日志失败: {e}")
+
+
+def start():
+    global _task, _closing
+    _closing = False
+    _task = asyncio.create_task(_writer())
+
+
+async def stop():
+    """写完剩下的日志后退出"""
+    global _closing
+    _closing = True
+    _wakeup.set()
+    if _task is not None:
+        await _task
@@ -0,0 +1,80 @@
+"""
+审核操作用的锁. 每条投稿一把锁, 推送到 Qzone 单独排队.
+加锁顺序固定为先 publish 再 article, 持有 article 锁时不要再等 publish.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import time
+
+import config
+
+
+@dataclass(slots=True)
+class WaitStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def __str__(self):
+        if not self.count:
+            return "无"
+        return (
+            f"{self.count} 次, 平均 {self.total / self.count * 1000:.0f}ms, "
+            f"最长 {self.max * 1000:.0f}ms"
+        )
+
+
+# 锁名 -> 等待时间
+waits: dict[str, WaitStats] = {"article": WaitStats(), "publish": WaitStats()}
+
+_articles: dict[str, asyncio.Lock] = {}
+# 正在使用或等待某把锁的数量, 归零时删掉这把锁
+_users: dict[str, int] = {}
+_publish = asyncio.Lock()
+
+
+def _record(name: str, waited: float, what: str):
+    stats = waits[name]
+    stats.count += 1
+    stats.total += waited
+    stats.max = max(stats.max, waited)
+    if waited >= config.LOCK_WARN:
+        from core import bot
+
+        bot.getLogger().warning(f"{what} 等待锁 {waited:.2f}s")
+
+
+@asynccontextmanager
+async def article(*ids: int | str):
+    """锁住这些投稿, 按固定顺序加锁避免死锁"""
+    keys = sorted({str(i) for i in ids})
+    for key in keys:
+        _users[key] = _users.get(key, 0) + 1
+        _articles.setdefault(key, asyncio.Lock())
+    acquired = []
+    start = time.perf_counter()
+    try:
+        for key in keys:
+            await _articles[key].acquire()
+            acquired.append(key)
+        _record("article", time.perf_counter() - start, f"投稿 {keys}")
+        yield
+    finally:
+        for key in reversed(acquired):
+            _articles[key].release()
+        for key in keys:
+            _users[key] -= 1
+            if _users[key] == 0:
+                del _users[key]
+                del _articles[key]
+
+
+@asynccontextmanager
+async def publish():
+    """推送到 Qzone 同时只能有一个"""
+    start = time.perf_counter()
+    async with _publish:
+        _record("publish", time.perf_counter() - start, "推送")
+        yield
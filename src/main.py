@@ -1,7 +1,14 @@
 import asyncio
 import os
 
+import agent
 import core
+import image
+import journal
+import render
+import repo
+import stats
+import utils
 
 if os.geteuid() == 0:
     print("请不要使用 root 用户运行此程序.")
@@ -9,11 +16,36 @@ if os.geteuid() == 0:
 
 os.makedirs("./data", exist_ok=True)
 os.makedirs("./data/bg", exist_ok=True)
+os.makedirs("./data/avatar", exist_ok=True)
+os.makedirs("./data/cache", exist_ok=True)
+os.makedirs("./data/store", exist_ok=True)
+
+core.bot.getLogger().info(f"已加载 {image.load_faces()} 个表情")
+stats.load()
+agent.cache.load()
+
+# 在创建其他线程之前先把图片处理进程 fork 出来
+image.process_pool.submit(int).result()
 
 
 async def main():
+    utils.http()
+    await image.browser.start()
+    render.queue.start()
+    # 先恢复中断的投稿, 再开始接收消息
+    await core.restore()
+    journal.start()
     core.scheduler.start()
-    await asyncio.gather(core.bot.start(), core.server.serve())
+    try:
+        await asyncio.gather(core.bot.start(), core.server.serve())
+    finally:
+        await journal.stop()
+        agent.cache.save()
+        await render.queue.stop()
+        await image.browser.stop()
+        image.process_pool.shutdown()
+        repo.shutdown()
+        await utils.close_http()
 
 
 asyncio.run(main())
@@ -1,17 +1,38 @@
+import asyncio
+import time
 from dataclasses import dataclass, field
 from enum import Enum
+from typing import Any
+from typing import Callable
 from peewee import (
     Model,
     SqliteDatabase,
     IntegerField,
     TextField,
-    AutoField,
     TimestampField,
     BooleanField,
     Field,
+    fn,
 )
+from playhouse.sqlite_ext import AutoIncrementField
 
-db = SqliteDatabase("data.db")
+import config
+import utils
+
+PRAGMAS = {
+    # WAL 下读写互不阻塞, 配合 synchronous=NORMAL 只在检查点时 fsync
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -config.SQLITE_CACHE_KB,
+    "mmap_size": config.SQLITE_MMAP_SIZE,
+    "temp_store": "memory",
+    "foreign_keys": 1,
+    "busy_timeout": 5000,
+}
+
+db = SqliteDatabase("data.db", pragmas=PRAGMAS)
+# 已经推送或驳回很久的投稿, 见 archive.py
+archive_db = SqliteDatabase("archive.db", pragmas=PRAGMAS)
 
 
 class EnumField(Field):
@@ -39,17 +60,18 @@ class Status(Enum):
 
 
 class Article(Model):
-    id = AutoField()
+    # 归档后主表的最大 id 会变小, 必须用 AUTOINCREMENT 保证 id 不被重用
+    id = AutoIncrementField()
 
-    sender_id = IntegerField(null=False)
+    sender_id = IntegerField(null=False, index=True)
     sender_name = TextField(null=False)
-    tid = TextField(null=True)
+    tid = TextField(null=True, index=True)
     time = TimestampField()
 
     anonymous = BooleanField()
     single = BooleanField()
 
-    status = EnumField(Status, default=Status.CREATED)
+    status = EnumField(Status, default=Status.CREATED, index=True)
     approve = TextField(null=True)
 
     mid = TextField(null=True)
@@ -61,11 +83,199 @@ class Article(Model):
         return f"#{self.id}"
 
 
+class Media(Model):
+    """QQ 图片文件名到内容哈希的索引, 见 store.py"""
+
+    file = TextField(primary_key=True)
+    sha = TextField(index=True)
+    size = IntegerField()
+
+    class Meta:
+        database = db
+
+
+class Approval(Model):
+    """审核人对投稿的同意, 每人每条投稿只记一次"""
+
+    article = IntegerField()
+    operator = IntegerField()
+    time = TimestampField()
+
+    class Meta:
+        database = db
+        indexes = ((("article", "operator"), True),)
+
+
+class ArchivedArticle(Article):
+    class Meta:
+        database = archive_db
+        table_name = "article"
+
+
 Article.create_table(safe=True)
+Media.create_table(safe=True)
+Approval.create_table(safe=True)
+ArchivedArticle.create_table(safe=True)
+
+
+# 数据库结构的升级步骤, 按顺序执行, 已执行到第几步记在 PRAGMA user_version 里.
+# 只能在末尾追加, 不要修改已有的步骤
+migrations: list[Callable[[], None]] = []
+
+
+def migration(func: Callable[[], None]):
+    migrations.append(func)
+    return func
+
+
+@migration
+def _add_article_indexes():
+    # 新建的表已经由 create_table 建好索引, 这里给旧的 data.db 补上
+    for column in ("status", "tid", "sender_id"):
+        db.execute_sql(
+            f'CREATE INDEX IF NOT EXISTS "article_{column}" ON "article" ("{column}")'
+        )
+
+
+@migration
+def _split_approvals():
+    # 把 Article.approve 里逗号分隔的审核人拆到 Approval 表. 驳回时那一列记的是驳回人, 不算
+    rows = []
+    for article in Article.select().where(
+        Article.status.in_([Status.CONFRIMED, Status.QUEUE, Status.PUBLISHED])
+        & Article.approve.is_null(False)
+    ):
+        for operator in article.approve.split(","):
+            if operator.strip():
+                rows.append(
+                    {
+                        "article": article.id,
+                        "operator": int(operator),
+                        "time": article.time,
+                    }
+                )
+    for i in range(0, len(rows), 500):
+        Approval.insert_many(rows[i : i + 500]).on_conflict_ignore().execute()
+
+
+@migration
+def _autoincrement_ids():
+    # 旧的 article 表没有 AUTOINCREMENT, 重建一次. 索引名会和新表冲突, 先删掉
+    sql = db.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'article'"
+    ).fetchone()[0]
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    for column in ("status", "tid", "sender_id"):
+        db.execute_sql(f'DROP INDEX IF EXISTS "article_{column}"')
+    db.execute_sql('ALTER TABLE "article" RENAME TO "article_old"')
+    Article.create_table()
+    columns = ", ".join(f'"{f.column_name}"' for f in Article._meta.sorted_fields)
+    db.execute_sql(
+        f'INSERT INTO "article" ({columns}) SELECT {columns} FROM "article_old"'
+    )
+    db.execute_sql('DROP TABLE "article_old"')
+
+
+def _seed_ids():
+    """新投稿的 id 要排在所有归档投稿之后"""
+    archived = ArchivedArticle.select(fn.MAX(ArchivedArticle.id)).scalar() or 0
+    row = db.execute_sql(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'article'"
+    ).fetchone()
+    current = max(row[0] if row else 0, Article.select(fn.MAX(Article.id)).scalar() or 0)
+    if archived <= current:
+        return
+    with db.atomic():
+        db.execute_sql("DELETE FROM sqlite_sequence WHERE name = 'article'")
+        db.execute_sql(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('article', ?)", (archived,)
+        )
+    # 这时 core 还没有创建 bot, 不能用它的日志
+    print(f"投稿 id 从 {archived + 1} 开始")
+
+
+def migrate():
+    version = db.execute_sql("PRAGMA user_version").fetchone()[0]
+    for i, func in enumerate(migrations[version:], start=version + 1):
+        with db.atomic():
+            func()
+            db.execute_sql(f"PRAGMA user_version = {i}")
+
+    _seed_ids()
+
+
+migrate()
 
 
 @dataclass(slots=True)
 class Session:
     id: int
     anonymous: bool
-    contents: list = field(default_factory=list)
+    # 消息 id -> 这条消息的内容, 按发送顺序, 撤回时直接按 id 删除
+    messages: dict[int, list] = field(default_factory=dict)
+    # 当前内容的大小, 用来限制一次投稿的内容
+    segments: int = 0
+    text_bytes: int = 0
+    images: int = 0
+    # 内容每次变化加一, 渲染完成后用来判断这期间内容有没有变
+    version: int = 0
+    # 当前 image.png 对应的内容哈希, 内容变化时置空
+    image_key: str | None = None
+    # 用户是否已经通过 #结束 看过当前内容的预览图
+    previewed: bool = False
+    # 后台预渲染的计时任务和渲染任务 (render.Job)
+    speculative: asyncio.Task | None = None
+    speculative_job: Any = None
+    # 图片文件名 -> 后台下载任务
+    downloads: dict[str, asyncio.Task] = field(default_factory=dict)
+    # 这次投稿已经下载的图片字节数
+    budget: utils.Budget = field(
+        default_factory=lambda: utils.Budget(config.SESSION_MAX_BYTES)
+    )
+    # 开始投稿的时间, 以及超时取消和提前提醒的定时器
+    created: float = field(default_factory=time.time)
+    expire_timer: asyncio.TimerHandle | None = None
+    warn_timer: asyncio.TimerHandle | None = None
+
+    @property
+    def contents(self) -> list[list]:
+        return list(self.messages.values())
+
+    def check(self, items: list) -> str | None:
+        """加入这条消息后超过上限时返回超出的是什么"""
+        segments, text_bytes, images = _measure(items)
+        if self.segments + segments > config.SESSION_MAX_SEGMENTS:
+            return f"消息不能超过 {config.SESSION_MAX_SEGMENTS} 段"
+        if self.text_bytes + text_bytes > config.SESSION_MAX_TEXT:
+            return f"文字不能超过 {config.SESSION_MAX_TEXT} 字节"
+        if self.images + images > config.SESSION_MAX_IMAGES:
+            return f"图片不能超过 {config.SESSION_MAX_IMAGES} 张"
+        return None
+
+    def add(self, message_id: int, items: list):
+        self.remove(message_id)
+        self.messages[message_id] = items
+        self._count(items, 1)
+        self.version += 1
+
+    def remove(self, message_id: int) -> list | None:
+        items = self.messages.pop(message_id, None)
+        if items is not None:
+            self._count(items, -1)
+            self.version += 1
+        return items
+
+    def _count(self, items: list, sign: int):
+        segments, text_bytes, images = _measure(items)
+        self.segments += sign * segments
+        self.text_bytes += sign * text_bytes
+        self.images += sign * images
+
+
+def _measure(items: list) -> tuple[int, int, int]:
+    text_bytes = sum(
+        len(m["data"]["text"].encode()) for m in items if m["type"] == "text"
+    )
+    images = sum(1 for m in items if m["type"] == "image")
+    return len(items), text_bytes, images
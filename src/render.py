@@ -0,0 +1,166 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable
+
+import config
+
+
+@dataclass(slots=True, eq=False)
+class Job:
+    key: Hashable
+    func: Callable[[], Awaitable[Any]]
+    # 低优先级任务 (预渲染) 只在有空闲 worker 时执行, 随时可能被抢占
+    low: bool = False
+    # 任务对应的内容哈希, 用来判断结果还能不能用
+    tag: str | None = None
+    future: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+    task: asyncio.Task | None = None
+
+    async def wait(self):
+        """等待渲染结束, 被取消时返回 None"""
+        await asyncio.wait([self.future])
+        if self.future.cancelled():
+            return None
+        return self.future.result()
+
+
+class RenderQueue:
+    """
+    有界的渲染队列, 固定数量的 worker 依次处理.
+    每个 key (用户) 最多只有一个等待中的任务, 重复提交会替换掉旧任务, 保证按用户公平排队.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        # dict 保留插入顺序, 即为排队顺序
+        self._pending: dict[Hashable, Job] = {}
+        self._low: dict[Hashable, Job] = {}
+        self._running: set[Job] = set()
+        self._idle = 0
+        self._cond = asyncio.Condition()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for key in list(self._pending) + list(self._low):
+            self.cancel(key)
+        for job in list(self._running):
+            self.drop(job)
+
+    async def submit(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        low: bool = False,
+        tag: str | None = None,
+    ) -> Job:
+        """提交任务, 队列已满时抛出 asyncio.QueueFull"""
+        lane = self._low if low else self._pending
+        old = lane.pop(key, None)
+        if old is not None:
+            old.future.cancel()
+        elif len(lane) >= self.maxsize:
+            raise asyncio.QueueFull()
+
+        job = Job(key=key, func=func, low=low, tag=tag)
+        async with self._cond:
+            lane[key] = job
+            if not low:
+                self._preempt()
+            self._cond.notify()
+        return job
+
+    def promote(self, job: Job):
+        """把预渲染任务提升为正常任务, 排到正常队列末尾"""
+        if not job.low:
+            return
+        job.low = False
+        if self._low.get(job.key) is job:
+            self._low.pop(job.key)
+            old = self._pending.pop(job.key, None)
+            if old is not None:
+                old.future.cancel()
+            self._pending[job.key] = job
+
+    def position(self, job: Job) -> int:
+        """前面还有多少个任务在排队, 正在渲染时为 0"""
+        for i, pending in enumerate(self._pending.values()):
+            if pending is job:
+                return i
+        return 0
+
+    def cancel(self, key: Hashable):
+        for lane in (self._pending, self._low):
+            job = lane.pop(key, None)
+            if job is not None:
+                job.future.cancel()
+        for job in list(self._running):
+            if job.key == key and job.task is not None:
+                job.task.cancel()
+
+    def drop(self, job: Job):
+        """只取消这一个任务"""
+        for lane in (self._pending, self._low):
+            if lane.get(job.key) is job:
+                lane.pop(job.key)
+        job.future.cancel()
+        if job.task is not None:
+            job.task.cancel()
+
+    def _preempt(self):
+        # 没有空闲 worker 时, 让出一个正在跑的预渲染
+        if self._idle > 0:
+            return
+        for job in self._running:
+            if job.low and job.task is not None:
+                job.task.cancel()
+                return
+
+    def _next(self) -> Job | None:
+        for lane in (self._pending, self._low):
+            if lane:
+                return lane.pop(next(iter(lane)))
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                self._idle += 1
+                try:
+                    await self._cond.wait_for(lambda: bool(self._pending or self._low))
+                finally:
+                    self._idle -= 1
+                job = self._next()
+            if job is None:
+                continue
+
+            self._running.add(job)
+            job.task = asyncio.create_task(job.func())
+            try:
+                await asyncio.wait([job.task])
+            finally:
+                self._running.discard(job)
+
+            if job.task.cancelled():
+                job.future.cancel()
+                continue
+            exc = job.task.exception()
+            if job.future.done():
+                continue
+            if exc is not None:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(job.task.result())
+
+
+queue = RenderQueue(workers=config.RENDER_WORKERS, maxsize=config.RENDER_QUEUE)
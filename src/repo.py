@@ -0,0 +1,180 @@
+"""
+数据库访问层. 所有查询都放到同一个后台线程里串行执行,
+事件循环只 await 结果, 磁盘慢或者查询大时不会卡住 websocket.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+from typing import Any, Callable, TypeVar
+
+import config
+from models import Approval, Article, ArchivedArticle, Status, db
+
+T = TypeVar("T")
+
+# SQLite 同时只能有一个写者, 用一个线程就不会出现锁竞争
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+def _timed(func: Callable[..., T], *args, **kwargs) -> T:
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        if elapsed >= config.SLOW_QUERY_MS:
+            from core import bot
+
+            bot.getLogger().warning(f"慢查询 {func.__name__}: {elapsed:.1f}ms")
+
+
+async def run(func: Callable[..., T], *args, **kwargs) -> T:
+    """在数据库线程中执行 func"""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, functools.partial(_timed, func, *args, **kwargs)
+    )
+
+
+def shutdown():
+    _executor.shutdown()
+
+
+def _create_article(**fields: Any) -> int:
+    return Article.create(**fields).id
+
+
+async def create_article(**fields: Any) -> int:
+    return await run(_create_article, **fields)
+
+
+def _get_article(
+    id: int | str,
+    status: Status | None = None,
+    exclude: Status | None = None,
+    archived: bool = False,
+) -> Article | None:
+    for model in (Article, ArchivedArticle) if archived else (Article,):
+        query = model.id == id
+        if status is not None:
+            query &= model.status == status
+        if exclude is not None:
+            query &= model.status != exclude
+        article = model.get_or_none(query)
+        if article is not None:
+            return article
+    return None
+
+
+async def get_article(
+    id: int | str,
+    status: Status | None = None,
+    exclude: Status | None = None,
+    archived: bool = False,
+) -> Article | None:
+    """
+    按 id 查找投稿, 可以限定状态.
+    archived 为 True 时主表里没有就再到归档库里找, 找到的是 ArchivedArticle
+    """
+    return await run(_get_article, id, status, exclude, archived)
+
+
+def _find_by_tid(tid: str) -> Article | None:
+    return Article.get_or_none(Article.tid == tid)
+
+
+async def find_by_tid(tid: str) -> Article | None:
+    """按审核群中的消息 id 查找投稿"""
+    return await run(_find_by_tid, str(tid))
+
+
+def _update_article(id: int | str, **fields: Any) -> int:
+    return Article.update(fields).where(Article.id == id).execute()
+
+
+async def update_article(id: int | str, **fields: Any) -> int:
+    return await run(_update_article, id, **fields)
+
+
+def _transition(id: int | str, old: Status, new: Status, **fields: Any) -> bool:
+    fields["status"] = new
+    return (
+        Article.update(fields)
+        .where((Article.id == id) & (Article.status == old))
+        .execute()
+        > 0
+    )
+
+
+async def transition(id: int | str, old: Status, new: Status, **fields: Any) -> bool:
+    """
+    只有投稿当前是 old 状态时才改为 new, 返回是否修改成功.
+    多个请求同时修改同一条投稿时只有一个会成功
+    """
+    return await run(_transition, id, old, new, **fields)
+
+
+def _approve(id: int | str, operator: int) -> list[int] | None:
+    with db.atomic():
+        added = (
+            Approval.insert(article=id, operator=operator, time=time.time())
+            .on_conflict_ignore()
+            # 默认返回 lastrowid, 冲突时不是 0
+            .as_rowcount()
+            .execute()
+        )
+        if not added:
+            return None
+        return [
+            a.operator
+            for a in Approval.select(Approval.operator)
+            .where(Approval.article == id)
+            .order_by(Approval.id.asc())
+        ]
+
+
+async def approve(id: int | str, operator: int) -> list[int] | None:
+    """记录一次同意, 返回目前所有的审核人. 这个人已经同意过时返回 None"""
+    return await run(_approve, int(id), operator)
+
+
+def _delete_article(id: int | str) -> bool:
+    # 归档中的投稿也一起删掉
+    deleted = Article.delete_by_id(id)
+    deleted += ArchivedArticle.delete_by_id(id)
+    Approval.delete().where(Approval.article == id).execute()
+    return deleted > 0
+
+
+async def delete_article(id: int | str) -> bool:
+    return await run(_delete_article, id)
+
+
+def _article_ids(status: Status | None = None) -> set[int]:
+    if status is not None:
+        query = Article.select(Article.id).where(Article.status == status)
+        return {a.id for a in query}
+    return {a.id for a in Article.select(Article.id)} | {
+        a.id for a in ArchivedArticle.select(ArchivedArticle.id)
+    }
+
+
+async def article_ids(status: Status | None = None) -> set[int]:
+    """某个状态的全部投稿 id, 不指定状态时包括归档的投稿"""
+    return await run(_article_ids, status)
+
+
+def _queued_articles(limit: int) -> list[Article]:
+    return list(
+        Article.select()
+        # 单发的投稿由通过它的人直接推送, 不参与合并推送
+        .where((Article.status == Status.QUEUE) & (Article.single == False))
+        .order_by(Article.id.asc())
+        .limit(limit)
+    )
+
+
+async def queued_articles(limit: int) -> list[Article]:
+    """待推送队列中最早的 limit 个投稿"""
+    return await run(_queued_articles, limit)
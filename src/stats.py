@@ -0,0 +1,67 @@
+"""
+投稿数量和待审核 / 待推送列表的内存缓存.
+每次状态变化时同步更新, 查询时不用扫描整张表; 定期用 SQL COUNT 校正.
+"""
+
+from models import Article, ArchivedArticle, Status
+
+# 需要记录 id 列表的状态
+TRACKED = (Status.CONFRIMED, Status.QUEUE)
+
+total = 0
+_ids: dict[Status, set[int]] = {s: set() for s in TRACKED}
+
+
+def query() -> tuple[int, dict[Status, set[int]]]:
+    """从数据库统计, 在数据库线程中执行"""
+    # 总数包括已经归档的投稿
+    count = Article.select().count() + ArchivedArticle.select().count()
+    ids = {
+        s: {a.id for a in Article.select(Article.id).where(Article.status == s)}
+        for s in TRACKED
+    }
+    return count, ids
+
+
+def apply(count: int, ids: dict[Status, set[int]]) -> bool:
+    """用统计结果覆盖内存中的数据, 不一致时返回 True"""
+    global total
+    drift = count != total or ids != _ids
+    if drift:
+        from core import bot
+
+        bot.getLogger().info(f"投稿统计已校正: 共 {total} -> {count} 单")
+    total = count
+    _ids.update(ids)
+    return drift
+
+
+def load() -> bool:
+    return apply(*query())
+
+
+def created(id: int):
+    global total
+    total += 1
+
+
+def moved(id: int, status: Status):
+    for s, ids in _ids.items():
+        if s == status:
+            ids.add(int(id))
+        else:
+            ids.discard(int(id))
+
+
+def removed(id: int):
+    global total
+    total -= 1
+    moved(id, Status.CREATED)
+
+
+def pending() -> list[int]:
+    return sorted(_ids[Status.CONFRIMED])
+
+
+def queued() -> list[int]:
+    return sorted(_ids[Status.QUEUE])
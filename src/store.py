@@ -0,0 +1,123 @@
+"""
+按内容哈希保存的图片仓库.
+同一张图片只在 data/store 中保存一份, 投稿文件夹里放的是指向它的硬链接,
+硬链接数就是引用计数: 只剩仓库自己这一个链接时才真正删除.
+"""
+
+import os
+import shutil
+
+from models import Media
+import repo
+import utils
+
+ROOT = "./data/store"
+
+
+def blob_path(sha: str) -> str:
+    return os.path.join(ROOT, sha[:2], sha)
+
+
+def _link(src: str, dst: str):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # 不在同一个文件系统上时只能复制
+        shutil.copyfile(src, dst)
+
+
+async def fetch(
+    url: str, file: str, dst: str, budget: utils.Budget | None = None
+):
+    """
+    下载 QQ 图片到 dst. file 是 QQ 给出的文件名,
+    已经下载过同名文件时直接链接, 内容重复时也只保留一份
+    """
+    media = await repo.run(Media.get_or_none, Media.file == file)
+    if media is not None and os.path.isfile(blob_path(media.sha)):
+        _link(blob_path(media.sha), dst)
+        return
+
+    os.makedirs(os.path.join(ROOT, "tmp"), exist_ok=True)
+    tmp = os.path.join(ROOT, "tmp", os.urandom(8).hex())
+    try:
+        sha = await utils.fetch(url, tmp, budget=budget)
+        if budget is not None:
+            # 不压缩传输, 计入额度的就是文件大小
+            budget.files[file] = os.path.getsize(tmp)
+        blob = blob_path(sha)
+        if not os.path.isfile(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(tmp, blob)
+        _link(blob, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    await repo.run(
+        Media.insert(
+            file=file, sha=sha, size=os.path.getsize(blob)
+        ).on_conflict_replace().execute
+    )
+
+
+def _lookup(names: list[str]) -> dict[str, str]:
+    return {
+        media.file: media.sha
+        for media in Media.select().where(Media.file.in_(names))
+    }
+
+
+def _forget(shas: list[str]):
+    Media.delete().where(Media.sha.in_(shas)).execute()
+
+
+async def _blobs(paths: list[str]) -> list[str]:
+    """找出这些文件对应的仓库图片"""
+    names = {os.path.basename(p): p for p in paths}
+    if not names:
+        return []
+    shas = []
+    for file, sha in (await repo.run(_lookup, list(names))).items():
+        blob = blob_path(sha)
+        path = names[file]
+        if os.path.isfile(blob) and os.path.samefile(blob, path):
+            shas.append(sha)
+    return shas
+
+
+async def _release(shas: list[str]):
+    removed = []
+    for sha in shas:
+        blob = blob_path(sha)
+        if os.path.isfile(blob) and os.stat(blob).st_nlink <= 1:
+            os.remove(blob)
+            removed.append(sha)
+    if removed:
+        await repo.run(_forget, removed)
+
+
+async def unlink(path: str):
+    """删除投稿中的一个文件, 没有其他投稿引用时顺带删除仓库中的图片"""
+    if not os.path.isfile(path):
+        return
+    shas = await _blobs([path])
+    os.remove(path)
+    await _release(shas)
+
+
+async def remove(folder: str):
+    """删除整个投稿文件夹"""
+    if not os.path.isdir(folder):
+        return
+    shas = await _blobs(
+        [
+            os.path.join(folder, f)
+            for f in os.listdir(folder)
+            if os.path.isfile(os.path.join(folder, f))
+        ]
+    )
+    shutil.rmtree(folder)
+    await _release(shas)
@@ -1,21 +1,202 @@
+import asyncio
 import base64
+from dataclasses import dataclass, field
+import hashlib
+import importlib.util
+import os
+import time
+
 import httpx
 
+import config
+
+_client: httpx.AsyncClient | None = None
+_download_slots = asyncio.Semaphore(config.DOWNLOAD_CONCURRENCY)
+
+# 常见图片格式的文件头
+IMAGE_MAGIC = [
+    b"\x89PNG\r\n\x1a\n",
+    b"\xff\xd8\xff",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+]
+
+
+class DownloadError(Exception):
+    """下载的内容不符合要求, 重试也没有用"""
+
+
+@dataclass(slots=True)
+class Budget:
+    """一次投稿所有下载共享的字节额度"""
+
+    limit: int
+    used: int = 0
+    # 下载完成的文件名 -> 计入额度的字节数, 撤回时退回
+    files: dict[str, int] = field(default_factory=dict)
+
+    def release(self, file: str):
+        self.used -= self.files.pop(file, 0)
+
+
+def is_image(head: bytes) -> bool:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return any(head.startswith(m) for m in IMAGE_MAGIC)
+
 
 def read_image(path: str) -> bytes:
     with open(path, mode="br") as f:
         return base64.b64encode(f.read())
 
 
-def to_list(l):
-    return list(map(lambda a: a.id, l))
+def http() -> httpx.AsyncClient:
+    """全局共享的 HTTP 客户端, 复用连接. 装了 h2 时启用 HTTP/2"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT
+            ),
+        )
+    return _client
+
+
+async def close_http():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
+async def download(
+    url: str,
+    filepath: str,
+    limit: int | None = None,
+    image: bool = False,
+    budget: Budget | None = None,
+    resume: bool = False,
+    timeout: float | None = None,
+) -> str:
+    """
+    下载文件, 返回内容的 sha256.
+    limit 为单个文件的字节上限, image 为 True 时检查文件头, 不是图片就立即中止.
+    resume 为 True 时失败后保留已下载的部分, 下次用 Range 请求接着下载.
+    timeout 为整个下载的秒数上限, 不填时只受 HTTP 客户端的超时限制
+    """
+    # 先写到临时文件, 下载中断时不会留下不完整的图片
+    part = f"{filepath}.part"
+    sha = hashlib.sha256()
+    offset = 0
+    if resume and os.path.isfile(part):
+        with open(part, mode="rb") as f:
+            while chunk := f.read(1 << 20):
+                sha.update(chunk)
+                offset += len(chunk)
 
-async def download(url: str, filepath: str):
-    async with httpx.AsyncClient(timeout=60) as client:
-        async with client.stream("GET", url) as resp:
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    start = time.perf_counter()
+    received = 0
+    # 计入额度的字节数, 续传时已下载的部分也要算上
+    charged = 0
+    done = False
+    try:
+        async with (
+            asyncio.timeout(timeout),
+            http().stream("GET", url, headers=headers) as resp,
+        ):
             resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                # 服务器不支持断点续传, 从头开始
+                offset = 0
+                sha = hashlib.sha256()
+            if budget is not None and offset:
+                budget.used += offset
+                charged += offset
+            length = resp.headers.get("Content-Length")
+            if limit is not None and length and offset + int(length) > limit:
+                raise DownloadError(f"文件超过 {limit // 1024 // 1024}MB")
 
-            with open(filepath, mode="wb") as file:
+            head = b""
+            with open(part, mode="ab" if offset else "wb") as file:
                 async for chunk in resp.aiter_bytes():
+                    received += len(chunk)
+                    if limit is not None and offset + received > limit:
+                        raise DownloadError(f"文件超过 {limit // 1024 // 1024}MB")
+                    if budget is not None:
+                        budget.used += len(chunk)
+                        charged += len(chunk)
+                        if budget.used > budget.limit:
+                            raise DownloadError(
+                                f"图片总大小超过 {budget.limit // 1024 // 1024}MB"
+                            )
+                    if image and offset == 0 and len(head) < 12:
+                        head += chunk[: 12 - len(head)]
+                        if len(head) >= 12 and not is_image(head):
+                            raise DownloadError("文件不是图片")
+                    sha.update(chunk)
                     file.write(chunk)
+            if image and offset == 0 and len(head) < 12 and not is_image(head):
+                raise DownloadError("文件不是图片")
+        os.replace(part, filepath)
+        done = True
+    except DownloadError:
+        resume = False
+        raise
+    finally:
+        if not done:
+            if budget is not None:
+                # 没下完的文件不计入额度
+                budget.used -= charged
+            if not resume and os.path.exists(part):
+                os.remove(part)
+        from core import bot
+
+        bot.getLogger().info(
+            f"下载 {url} {'完成' if done else '失败'}: "
+            f"{offset + received} 字节, 用时 {time.perf_counter() - start:.2f}s"
+        )
+    return sha.hexdigest()
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        code = e.response.status_code
+        return code >= 500 or code in (408, 429)
+    return isinstance(e, (httpx.TransportError, OSError))
+
+
+async def fetch(url: str, filepath: str, budget: Budget | None = None) -> str:
+    """
+    下载投稿图片: 限制同时下载的数量和文件大小, 检查是否为图片,
+    失败时指数退避重试, 重试时从断开的地方继续
+    """
+    try:
+        for attempt in range(config.DOWNLOAD_RETRIES + 1):
+            try:
+                async with _download_slots:
+                    return await download(
+                        url,
+                        filepath,
+                        limit=config.DOWNLOAD_MAX_BYTES,
+                        image=True,
+                        budget=budget,
+                        resume=True,
+                    )
+            except Exception as e:
+                if attempt >= config.DOWNLOAD_RETRIES or not _retryable(e):
+                    raise
+            await asyncio.sleep(config.DOWNLOAD_BACKOFF * 2**attempt)
+        raise DownloadError("重试次数已用完")
+    finally:
+        if os.path.exists(f"{filepath}.part"):
+            os.remove(f"{filepath}.part")
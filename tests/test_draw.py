@@ -0,0 +1,132 @@
+"""
+draw.draw_card 和 Chromium 渲染 normal.html 的结果对比.
+两边都只用 fonts/ 里的字体 (Noto Sans CJK SC 的子集), 结果不受系统字体影响.
+参考图 golden/text_face.png 由 Chromium 生成, 修改模板或 draw.py 后在仓库根目录执行重新生成:
+
+    uv run tests/test_draw.py --update
+
+改了测试用的文字时, 还要用 fonttools 的 pyftsubset 重新生成字体子集, 保证包含所有用到的字.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS = os.path.join(ROOT, "tests")
+GOLDEN = os.path.join(TESTS, "golden", "text_face.png")
+FONT = os.path.join(TESTS, "fonts", "NotoSansCJKsc-Regular.otf")
+
+# 与 image.SCALE 和 image.CROP 的默认值一致
+SCALE = 3
+CROP = 64
+# 固定的投稿, 格式和收到的 QQ 消息段相同
+CONTENTS = [
+    [
+        {"type": "text", "data": {"text": "今天天气真好, 一起去公园吧"}},
+        {"type": "face", "data": {"id": "14"}},
+    ],
+    [{"type": "text", "data": {"text": "第二条消息\n换一行 Hello 123"}}],
+]
+CARD = dict(
+    id=1,
+    username="测试用户",
+    user_id=10000,
+    anonymous=False,
+    admin=False,
+    date="2025-01-01 12:00:00",
+    avatar=None,
+    bg_img=None,
+)
+# 允许的尺寸误差 (像素) 和平均每通道误差 (0-255). 两边的字形光栅化和抗锯齿不完全相同
+SIZE_TOLERANCE = 6
+DIFF_TOLERANCE = 4.5
+
+
+def _face(id: str) -> bytes:
+    with open(os.path.join(ROOT, "face", f"{id}.png"), mode="rb") as f:
+        return f.read()
+
+
+def _messages() -> list[list[tuple[str, str | bytes | None]]]:
+    # 和 image._simple_items 相同, 这里不依赖 image 模块
+    return [
+        [
+            ("text", d["data"]["text"])
+            if d["type"] == "text"
+            else ("face", _face(d["data"]["id"]))
+            for d in items
+        ]
+        for items in CONTENTS
+    ]
+
+
+def test_draw_card_matches_chromium():
+    Image = pytest.importorskip("PIL.Image")
+    ImageChops = pytest.importorskip("PIL.ImageChops")
+    ImageStat = pytest.importorskip("PIL.ImageStat")
+    import draw
+
+    img, _ = draw.draw_card(
+        **CARD,
+        messages=_messages(),
+        font_path=FONT,
+        bold_path=None,
+        scale=SCALE,
+        crop=CROP,
+    )
+    with Image.open(GOLDEN) as f:
+        golden = f.convert("RGB")
+    img = img.convert("RGB")
+
+    assert abs(img.width - golden.width) <= SIZE_TOLERANCE
+    assert abs(img.height - golden.height) <= SIZE_TOLERANCE
+    if img.size != golden.size:
+        img = img.resize(golden.size, Image.Resampling.BILINEAR)
+    diff = ImageStat.Stat(ImageChops.difference(img, golden)).mean
+    assert sum(diff) / len(diff) <= DIFF_TOLERANCE
+
+
+def _fontconfig() -> str:
+    """只包含 fonts/ 的 fontconfig 配置, Chromium 找不到其他字体"""
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "fonts.conf")
+    with open(path, mode="w", encoding="utf-8") as f:
+        f.write(
+            "<?xml version='1.0'?>\n<fontconfig>\n"
+            f"  <dir>{os.path.dirname(FONT)}</dir>\n"
+            f"  <cachedir>{folder}</cachedir>\n"
+            "</fontconfig>\n"
+        )
+    return path
+
+
+async def _update():
+    # 要在启动 Chromium 之前设置, 浏览器进程继承这个环境变量
+    os.environ["FONTCONFIG_FILE"] = _fontconfig()
+    import image
+
+    assert (image.SCALE, image.CROP) == (SCALE, CROP), "RENDER_SCALE 要用默认值"
+    image.load_faces()
+    html = image.env.get_template("normal.html").render(
+        **CARD, contents=image.template_contents(CARD["id"], CONTENTS)
+    )
+    await image.browser.start()
+    try:
+        tiles = await image.screenshoot(html)
+    finally:
+        await image.browser.stop()
+    os.makedirs(os.path.dirname(GOLDEN), exist_ok=True)
+    with open(GOLDEN, mode="wb") as f:
+        f.write(tiles[0])
+    print(f"已生成 {GOLDEN}")
+
+
+if __name__ == "__main__" and "--update" in sys.argv:
+    # 模板和表情都按相对路径读取
+    os.chdir(ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    asyncio.run(_update())